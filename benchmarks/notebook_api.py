@@ -0,0 +1,98 @@
+"""
+Helpers shared by the benchmark notebooks that drive kernels.
+
+The notebooks talk to the notebook server that runs them as a browser
+does: they start kernels through the REST API and run code over the kernel
+websocket. The kernel of the notebook already runs an event loop, so the
+benchmarks run theirs on a thread of their own with run_async().
+"""
+
+import asyncio
+import json
+import threading
+import uuid
+
+from notebook import notebookapp
+from tornado import httpclient, websocket
+
+
+class NotebookServer(object):
+    "The notebook server that runs this notebook"
+
+    def __init__(self):
+        server = next(notebookapp.list_running_servers())
+        self.base = 'http://127.0.0.1:%d%s' % (server['port'],
+                                               server['base_url'])
+        self.headers = {'Authorization': 'token ' + server['token']}
+
+    async def start_kernel(self):
+        "Start a kernel and return its ID"
+        resp = await httpclient.AsyncHTTPClient().fetch(
+            self.base + 'api/kernels', method='POST', body='{}',
+            headers=self.headers)
+        return json.loads(resp.body.decode('utf-8'))['id']
+
+    async def stop_kernel(self, kernel):
+        "Shut down a kernel"
+        await httpclient.AsyncHTTPClient().fetch(
+            self.base + 'api/kernels/' + kernel, method='DELETE',
+            headers=self.headers)
+
+    async def connect(self, kernel, **kwargs):
+        """Open the websocket of a kernel.
+
+        kwargs go to websocket_connect, such as compression_options.
+        """
+        url = self.base.replace('http', 'ws', 1) + 'api/kernels/' + \
+            kernel + '/channels'
+        return await websocket.websocket_connect(
+            httpclient.HTTPRequest(url, headers=self.headers), **kwargs)
+
+
+def execute_request(code, user_expressions=None):
+    "Return an execute_request message in the format of the websocket"
+    header = {'msg_id': uuid.uuid4().hex, 'msg_type': 'execute_request',
+              'session': uuid.uuid4().hex, 'username': '', 'version': '5.2',
+              'date': ''}
+    return {'header': header, 'parent_header': {}, 'metadata': {},
+            'buffers': [], 'channel': 'shell',
+            'content': {'code': code, 'silent': False,
+                        'store_history': False,
+                        'user_expressions': user_expressions or {},
+                        'allow_stdin': False, 'stop_on_error': True}}
+
+
+async def replies(conn, msg):
+    "Send a message on a kernel websocket and yield the replies to it"
+    conn.write_message(json.dumps(msg))
+    while True:
+        raw = await conn.read_message()
+        if raw is None:
+            raise RuntimeError('The websocket was closed.')
+        if not isinstance(raw, str):
+            continue
+        reply = json.loads(raw)
+        if reply['parent_header'].get('msg_id') == msg['header']['msg_id']:
+            yield reply
+
+
+def run_async(coroutine):
+    "Run a coroutine on a thread with its own event loop and return its value"
+    result = {}
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            result['value'] = loop.run_until_complete(coroutine)
+        except Exception as e:
+            result['error'] = e
+        finally:
+            loop.close()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    if 'error' in result:
+        raise result['error']
+    return result['value']
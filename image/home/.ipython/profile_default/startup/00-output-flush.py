@@ -0,0 +1,20 @@
+# Set how often kernels send buffered output to the notebook.
+#
+# spyder_jupyter.py --output-profile sets KERNEL_OUTPUT_FLUSH_INTERVAL in
+# seconds. A longer interval coalesces many small writes, such as the lines
+# of a solver convergence log, into fewer and larger IOPub messages.
+
+
+def _set_output_flush_interval():
+    import os
+    import sys
+
+    interval = os.environ.get('KERNEL_OUTPUT_FLUSH_INTERVAL')
+    if interval:
+        for stream in (sys.stdout, sys.stderr):
+            if hasattr(stream, 'flush_interval'):
+                stream.flush_interval = float(interval)
+
+
+_set_output_flush_interval()
+del _set_output_flush_interval
@@ -1,5 +1,7 @@
 # Configuration file for jupyter-notebook.
 
+import os
+
 #------------------------------------------------------------------------------
 # Application(SingletonConfigurable) configuration
 #------------------------------------------------------------------------------
@@ -264,6 +266,11 @@ c.NotebookApp.terminado_settings = {'shell_command': ['/bin/zsh', '-l']}
 #  uses.
 #c.NotebookApp.tornado_settings = {}
 
+## spyder_jupyter.py --output-profile bulk sets JUPYTER_WEBSOCKET_COMPRESSION to
+#  compress the messages to the browser with permessage-deflate.
+if os.environ.get('JUPYTER_WEBSOCKET_COMPRESSION'):
+    c.NotebookApp.tornado_settings.update({'websocket_compression_options': {}})
+
 ## Whether to trust or not X-Scheme/X-Forwarded-Proto and X-Real-Ip/X-Forwarded-
 #  For headerssent by the upstream reverse proxy. Necessary if the proxy handles
 #  SSL
@@ -603,3 +610,163 @@ c.NotebookApp.terminado_settings = {'shell_command': ['/bin/zsh', '-l']}
 #  
 #  By default, all installed kernels are allowed.
 #c.KernelSpecManager.whitelist = set()
+
+#------------------------------------------------------------------------------
+# Kernel memory watchdog
+#------------------------------------------------------------------------------
+
+## spyder_jupyter.py --max-kernel-memory sets KERNEL_MEMORY_LIMIT to a number
+#  of bytes. Every KERNEL_WATCHDOG_INTERVAL seconds, the resident memory of
+#  each kernel and its child processes is added up, and kernels above the
+#  limit are killed so that the server restarts them. The memory of kernels
+#  that go away, whether stopped by the watchdog, culled or shut down, is
+#  reported as reclaimed in the server log.
+def kernel_memory_watchdog(limit, interval):
+    import json
+    import re
+    import signal
+    import sys
+    import time
+
+    page = os.sysconf('SC_PAGE_SIZE')
+
+    def log(level, msg):
+        sys.stderr.write('[%s %s KernelWatchdog] %s\n' %
+                         (level, time.strftime('%H:%M:%S.000'), msg))
+        sys.stderr.flush()
+
+    def processes():
+        "Return the parent and resident memory of every process"
+        procs = {}
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+            try:
+                with open('/proc/' + pid + '/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+                with open('/proc/' + pid + '/statm') as f:
+                    rss = int(f.read().split()[1]) * page
+                procs[int(pid)] = (ppid, rss)
+            except (IOError, OSError, ValueError, IndexError):
+                pass
+        return procs
+
+    def kernels():
+        "Return the kernel ID of every kernel process"
+        found = {}
+        for pid in os.listdir('/proc'):
+            try:
+                with open('/proc/' + pid + '/cmdline') as f:
+                    cmdline = f.read()
+            except (IOError, OSError):
+                continue
+            m = re.search(r'kernel-([\w-]+)\.json', cmdline)
+            if m and 'ipykernel' in cmdline:
+                found[int(pid)] = m.group(1)
+        return found
+
+    def forked():
+        "Return the PID of the kernel of each launcher of forkkernel"
+        if not os.environ.get('KERNEL_FORK_SOCKET'):
+            return {}
+        try:
+            with open(os.path.splitext(os.environ['KERNEL_FORK_SOCKET'])[0] +
+                      '.json') as f:
+                return dict((int(k), v) for k, v in json.load(f).items())
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def mb(size):
+        return '%.0f MB' % (size / 1048576.0)
+
+    last = {}
+    reclaimed = 0
+    while True:
+        time.sleep(interval)
+        procs = processes()
+        children = {}
+        for pid, (ppid, _) in procs.items():
+            children.setdefault(ppid, []).append(pid)
+
+        usage = {}
+        found = kernels()
+        launchers = forked()
+        for pid, kernel in found.items():
+            if procs.get(pid, (0, 0))[0] in found:
+                # Forked by a kernel, such as a multiprocessing worker
+                continue
+            tree = [pid]
+            if pid in launchers:
+                # The kernel is forked by the server of forkkernel
+                tree.append(launchers[pid])
+            for p in tree:
+                tree += children.get(p, [])
+            rss = sum(procs[p][1] for p in tree if p in procs)
+
+            if rss > limit:
+                for p in reversed(tree):
+                    try:
+                        os.kill(p, signal.SIGKILL)
+                    except OSError:
+                        pass
+                reclaimed += rss
+                log('W', 'Restarted kernel %s, which used %s of %s allowed. '
+                    'Reclaimed %s in total.' %
+                    (kernel, mb(rss), mb(limit), mb(reclaimed)))
+            else:
+                usage[pid] = (kernel, rss)
+
+        # Kernels that were culled or shut down since the last check
+        for pid, (kernel, rss) in last.items():
+            if pid not in usage:
+                reclaimed += rss
+                log('I', 'Kernel %s has exited, which reclaimed %s. '
+                    'Reclaimed %s in total.' % (kernel, mb(rss), mb(reclaimed)))
+        last = usage
+
+if os.environ.get('KERNEL_MEMORY_LIMIT'):
+    import threading
+
+    watchdog = threading.Thread(target=kernel_memory_watchdog,
+                                args=(int(os.environ['KERNEL_MEMORY_LIMIT']),
+                                      float(os.environ.get('KERNEL_WATCHDOG_INTERVAL', 60))))
+    watchdog.daemon = True
+    watchdog.start()
+
+#------------------------------------------------------------------------------
+# Forking kernels
+#------------------------------------------------------------------------------
+
+## spyder_jupyter.py --preload-kernel sets KERNEL_PRELOAD to the modules, separated
+#  by commas, that a server of ~/.local/bin/forkkernel imports once. A python3
+#  kernelspec in the runtime directory, which JUPYTER_PATH puts before the
+#  stock one, then forks new kernels from it through KERNEL_FORK_SOCKET.
+#  Kernels that start before the server is ready, or when it is not running,
+#  start as usual. Without KERNEL_PRELOAD, the stock kernelspec is used.
+if os.environ.get('KERNEL_PRELOAD'):
+    import json
+    import subprocess
+    from jupyter_core.paths import jupyter_runtime_dir
+
+    runtime_dir = jupyter_runtime_dir()
+    if not os.path.isdir(runtime_dir):
+        os.makedirs(runtime_dir, 0o700)
+
+    forkkernel = os.path.expanduser('~/.local/bin/forkkernel')
+    fork_socket = os.path.join(runtime_dir, 'forkkernel-%d.sock' % os.getpid())
+    subprocess.Popen([forkkernel, '--serve', fork_socket,
+                      '--preload', os.environ['KERNEL_PRELOAD']])
+    os.environ['KERNEL_FORK_SOCKET'] = fork_socket
+
+    spec_root = os.path.join(runtime_dir, 'forkkernel')
+    spec_dir = os.path.join(spec_root, 'kernels', 'python3')
+    if not os.path.isdir(spec_dir):
+        os.makedirs(spec_dir)
+    with open(os.path.join(spec_dir, 'kernel.json'), 'w') as f:
+        json.dump({'argv': [forkkernel, 'python3', '-m', 'ipykernel_launcher',
+                            '-f', '{connection_file}'],
+                   'display_name': 'Python 3',
+                   'language': 'python'}, f, indent=1)
+    jupyter_path = os.environ.get('JUPYTER_PATH', '').split(os.pathsep)
+    os.environ['JUPYTER_PATH'] = os.pathsep.join(
+        [spec_root] + [p for p in jupyter_path if p])
@@ -14,6 +14,14 @@ import sys
 import subprocess
 import time
 import os
+import socket
+import struct
+import threading
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
 
 owner = "compdatasci"
 proj = os.path.basename(sys.argv[0]).split('_')[0]
@@ -22,15 +30,24 @@ tag = ""
 projdir = "project"
 workdir = "project"
 volume = proj + "_project"
+docker_user = "ubuntu"
+docker_home = "/home/" + docker_user
+label_ns = image.replace('/', '.') + '.'
+statedir = os.path.join(os.path.expanduser('~'), '.' + image.split('/')[-1])
+
 
+def parse_args(description, argv=None, command=None):
+    """Parse command-line arguments.
 
-def parse_args(description):
-    "Parse command-line arguments"
+    A command such as "pool" adds its own options to the launcher options.
+    """
 
     import argparse
 
     # Process command-line arguments
-    parser = argparse.ArgumentParser(description=description)
+    parser = argparse.ArgumentParser(
+        description=description,
+        prog=os.path.basename(sys.argv[0]) + (' ' + command if command else ''))
 
     parser.add_argument('-i', '--image',
                         help='The Docker image to use. ' +
@@ -54,7 +71,14 @@ def parse_args(description):
 
     parser.add_argument('-p', '--pull',
                         help='Pull the latest Docker image. ' +
-                        'The default is not to pull.',
+                        'The pull is skipped if the local image matches the ' +
+                        'registry. The default is not to pull.',
+                        action='store_true',
+                        default=False)
+
+    parser.add_argument('--pull-background',
+                        help='With --pull, launch the current image and pull ' +
+                        'the new one in the background for the next launch.',
                         action='store_true',
                         default=False)
 
@@ -63,6 +87,13 @@ def parse_args(description):
                         action='store_true',
                         default=False)
 
+    parser.add_argument('--no-golden',
+                        help='Start a new config volume empty instead of ' +
+                        'as a clone of the golden config volume of the ' +
+                        'image, which the "golden" command builds.',
+                        action='store_true',
+                        default=False)
+
     parser.add_argument('-c', '--clear',
                         help='Clear the project data volume (please use with caution).',
                         action='store_true',
@@ -73,9 +104,19 @@ def parse_args(description):
                         action='store_true',
                         default=False)
 
+    parser.add_argument('--sync',
+                        help='Keep the working directory on a Docker volume ' +
+                        'and synchronize it with the host directory while ' +
+                        'the launcher runs. File I/O in ~/shared is much ' +
+                        'faster than with the default bind mount on Mac ' +
+                        'and Windows.',
+                        action='store_true',
+                        default=False)
+
     parser.add_argument('-s', '--size',
                         help='Size of the screen. The default is to use ' +
-                        'the current screen size.',
+                        'the current screen size, or $SCREEN_RESOLUTION ' +
+                        'if it is set.',
                         default="")
 
     parser.add_argument('-n', '--no-browser',
@@ -104,7 +145,223 @@ def parse_args(description):
                         'Useful for specifying additional resources or environment variables.',
                         default="")
 
-    args = parser.parse_args()
+    parser.add_argument('--cpus',
+                        help='Number of CPUs the container may use, auto to ' +
+                        'share the CPUs of the host with the running sessions, ' +
+                        'or none. The default is none.',
+                        default='none')
+
+    parser.add_argument('--memory',
+                        help='Memory limit of the container such as 16g, auto ' +
+                        'to share the memory of the host with the running ' +
+                        'sessions, or none. The default is none.',
+                        default='none')
+
+    parser.add_argument('--cpuset',
+                        help='CPUs to pin the container to, such as 0-3, auto to ' +
+                        'pick CPUs that other sessions do not use, or none. ' +
+                        'The default is none.',
+                        default='none')
+
+    parser.add_argument('--threads',
+                        help='Number of threads for OpenMP, BLAS and PETSc in ' +
+                        'the container, auto for the CPUs of the container, ' +
+                        'or none. The default is auto.',
+                        default='auto')
+
+    parser.add_argument('--mpi-ranks',
+                        help='Number of MPI ranks to size the container for. ' +
+                        'It sets the auto values of --cpus, --threads and ' +
+                        '--shm-size, and Open MPI shared-memory transport.',
+                        type=int, default=0)
+
+    parser.add_argument('--vnc-quality',
+                        help='JPEG quality of the desktop in noVNC, from 0 ' +
+                        'for the smallest updates to 9 for the best ' +
+                        'image, or auto to choose from the round-trip ' +
+                        'time and bandwidth of the ssh connection that ' +
+                        'the launcher runs in. By default, noVNC chooses.',
+                        choices=['auto'] + [str(i) for i in range(10)],
+                        metavar='{auto,0-9}',
+                        default=None)
+
+    parser.add_argument('--vnc-compression',
+                        help='Compression level of the desktop in noVNC, ' +
+                        'from 0 for the least CPU to 9 for the fewest ' +
+                        'bytes, or auto to choose as for --vnc-quality. ' +
+                        'By default, noVNC chooses.',
+                        choices=['auto'] + [str(i) for i in range(10)],
+                        metavar='{auto,0-9}',
+                        default=None)
+
+    parser.add_argument('--vnc-report',
+                        help='After startup, time full-screen VNC updates ' +
+                        'of the desktop in the container for this many ' +
+                        'seconds, and print the frame rate, the bytes per ' +
+                        'frame and the frame rate that the link to the ' +
+                        'browser allows. The default is 5 seconds.',
+                        nargs='?', const=5, type=float, metavar='SECONDS',
+                        default=None)
+
+    parser.add_argument('--mpi-test',
+                        help='Run an MPI ping-pong in the container after it ' +
+                        'starts and print the latency and bandwidth.',
+                        action='store_true',
+                        default=False)
+
+    parser.add_argument('--cache-size',
+                        help='Size that the ~/.cache volume of the image ' +
+                        'may use, such as 2G, or none for no limit. The ' +
+                        'least recently used files beyond it are removed ' +
+                        'when a session starts. 0 mounts no cache volume. ' +
+                        'The default is 2G.',
+                        default='2G')
+
+    parser.add_argument('--clear-cache',
+                        help='Remove the ~/.cache volume of the image, so ' +
+                        'that the session starts with an empty cache.',
+                        action='store_true',
+                        default=False)
+
+    parser.add_argument('--shm-size',
+                        help='Size of /dev/shm such as 2g, or auto for half of ' +
+                        'the memory limit, or 2g without one. The default ' +
+                        'is auto.',
+                        default='auto')
+
+    parser.add_argument('--log-lines',
+                        help='Number of log lines to keep in memory and show ' +
+                        'if the container stops. The default is 1000.',
+                        type=int, default=1000)
+
+    parser.add_argument('--log-level',
+                        help='Lowest level of the log lines to show. ' +
+                        'The default is info.',
+                        choices=['debug', 'info', 'warning', 'error', 'critical'],
+                        default='info')
+
+    parser.add_argument('--log-max-size',
+                        help='Size at which the logs of the container are ' +
+                        'rotated and compressed. The default is 10m.',
+                        default='10m')
+
+    parser.add_argument('--backend',
+                        help='How to talk to Docker: "api" uses the Docker ' +
+                        'Engine API at DOCKER_HOST, "cli" runs the docker ' +
+                        'command, and "auto" uses the API when it is reachable. ' +
+                        'The default is auto.',
+                        choices=['auto', 'api', 'cli'],
+                        default=os.environ.get('DOCKER_BACKEND', 'auto'))
+
+    parser.add_argument('--ready-timeout',
+                        help='Seconds to wait for the server to answer HTTP ' +
+                        'requests before opening the browser. The default is 30.',
+                        type=float, default=30)
+
+    parser.add_argument('--profile-startup',
+                        help='Time each phase of the launch and print a ' +
+                        'summary. If a file is given, also append the ' +
+                        'timings to it as a JSON line.',
+                        nargs='?', const='-', metavar='FILE',
+                        default=None)
+
+    parser.add_argument('--new',
+                        help='Start a new container even if a container for ' +
+                        'the same image, volume and directory is running. ' +
+                        'By default, the launcher reattaches to it.',
+                        action='store_true',
+                        default=False)
+
+    parser.add_argument('--no-daemon',
+                        help='Start the session in this process even if ' +
+                        'the session daemon of the "serve" command is ' +
+                        'running.',
+                        action='store_true',
+                        default=False)
+
+    parser.add_argument('--pool',
+                        help='Use a warm container started by the "pool" ' +
+                        'command if one with the same settings is ready. ' +
+                        'Any user and directory can claim it: the working ' +
+                        'directory is synchronized into it as with --sync, ' +
+                        'and ~/.ssh and other files of the home directory ' +
+                        'are not mounted. Later launches do not reattach ' +
+                        'to it.',
+                        action='store_true',
+                        default=False)
+
+    if command == 'pool':
+        parser.add_argument('--pool-size',
+                            help='Number of warm containers to keep ready. ' +
+                            'The default is 2.',
+                            type=int, default=2)
+
+        parser.add_argument('--idle-expire',
+                            help='Replace warm containers that have been idle ' +
+                            'for this many seconds. The default is 3600.',
+                            type=float, default=3600)
+
+        parser.add_argument('--refill-interval',
+                            help='Start at most one warm container every this ' +
+                            'many seconds. The default is 10.',
+                            type=float, default=10)
+
+        parser.add_argument('--paused',
+                            help='Pause warm containers once the desktop is ' +
+                            'up, so that they use no CPU while waiting.',
+                            action='store_true',
+                            default=False)
+
+    if command == 'gc':
+        parser.add_argument('--image-budget',
+                            help='Disk space that the images of the repository ' +
+                            'may use, such as 30G. The default is 30G.',
+                            default='30G')
+
+        parser.add_argument('--dry-run',
+                            help='Only print the tags that would be removed.',
+                            action='store_true',
+                            default=False)
+
+    if command == 'snapshot':
+        parser.add_argument('--list',
+                            help='List the snapshots of the volume.',
+                            action='store_true',
+                            default=False)
+
+        parser.add_argument('--keep',
+                            help='Keep only this many of the newest ' +
+                            'snapshots of the volume, and remove the ' +
+                            'chunks that no snapshot uses any more. By ' +
+                            'default, all snapshots are kept.',
+                            type=int, default=0)
+
+    if command == 'serve':
+        parser.add_argument('--bind',
+                            help='Address to serve the API on. The ' +
+                            'default is 127.0.0.1.',
+                            default='127.0.0.1')
+
+        parser.add_argument('--port',
+                            help='Port to serve the API on. The default ' +
+                            'is any free port.',
+                            type=int, default=0)
+
+    if command == 'resize':
+        parser.add_argument('new_size',
+                            help='The new size of the desktop, such as ' +
+                            '1920x1080. It cannot exceed the size the ' +
+                            'desktop started with. The default is the ' +
+                            'current screen size.',
+                            nargs='?', default=None)
+
+    if command == 'restore':
+        parser.add_argument('snapshot',
+                            help='The snapshot to restore, as listed by ' +
+                            '"snapshot --list". The default is the newest.',
+                            nargs='?', default=None)
+
+    args = parser.parse_args(argv)
     # Append tag to image if the image has no tag
     if args.image.find(':') < 0:
         if not args.tag:
@@ -115,20 +372,6 @@ def parse_args(description):
     return args
 
 
-def random_ports(port, n):
-    """Generate a list of n random ports near the given port.
-
-    The first 5 ports will be sequential, and the remaining n-5 will be
-    randomly selected in the range [port-2*n, port+2*n].
-    """
-    import random
-
-    for i in range(min(5, n)):
-        yield port + i
-    for i in range(n - 5):
-        yield max(1, port + random.randint(-2 * n, 2 * n))
-
-
 def id_generator(size=6):
     """Generate a container ID"""
     import random
@@ -138,302 +381,4480 @@ def id_generator(size=6):
     return proj + "-" + (''.join(random.choice(chars) for _ in range(size)))
 
 
-def find_free_port(port, retries):
-    "Find a free port"
-    import socket
+def state_path(*names):
+    "Return a path in the launcher state directory, creating the directory"
+
+    path = os.path.join(statedir, *names)
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        # The directory already exists
+        pass
+    return path
+
+
+class FileLock(object):
+    """Exclusive lock on a file, used as a context manager.
+
+    The lock serializes launchers on the same host, including launches
+    from different threads of one process. acquire(blocking=False) tries
+    the lock without waiting, for locks that are held while a launcher
+    runs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def acquire(self, blocking=True):
+        "Take the lock and return True, or False if it is held elsewhere"
 
-    for prt in random_ports(port, retries + 1):
+        self.file = open(self.path, 'a+')
         try:
-            sock.bind(("127.0.0.1", prt))
-            sock.close()
-            return prt
-        except socket.error:
-            continue
+            try:
+                import fcntl
 
-    return ''
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX |
+                            (0 if blocking else fcntl.LOCK_NB))
+            except ImportError:
+                import msvcrt
+
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK
+                               if blocking else msvcrt.LK_NBLCK, 1)
+        except (IOError, OSError):
+            if blocking:
+                raise
+            self.file.close()
+            self.file = None
+            return False
+        return True
+
+    def release(self):
+        "Release the lock"
+
+        try:
+            import fcntl
+
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        except ImportError:
+            import msvcrt
+
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
 
 
-def wait_net_service(port, timeout=30):
-    """ Wait for network service to appear.
+class PortRegistry(object):
+    """Allocator of host ports that concurrent launches never share.
+
+    Ports come from the kernel by binding to port 0, with all sockets of
+    one allocation bound at the same time so that they are distinct.
+    Docker binds a port only when the container starts, so allocated
+    ports are recorded in a locked registry file for ttl seconds and
+    are not handed out again in that time.
+    """
+
+    def __init__(self, path=None, ttl=600):
+        self.path = path or state_path('ports.json')
+        self.ttl = ttl
+
+    def allocate(self, n):
+        "Return a list of n free ports"
+        import json
+
+        with FileLock(self.path + '.lock'):
+            try:
+                with open(self.path) as f:
+                    reserved = json.load(f)
+            except (IOError, ValueError):
+                reserved = {}
+
+            now = time.time()
+            reserved = dict((port, expiry) for port, expiry in reserved.items()
+                            if expiry > now)
+
+            ports = []
+            socks = []
+            try:
+                while len(ports) < n:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    socks.append(sock)
+                    sock.bind(('', 0))
+                    port = sock.getsockname()[1]
+                    if str(port) not in reserved:
+                        ports.append(port)
+            finally:
+                for sock in socks:
+                    sock.close()
+
+            for port in ports:
+                reserved[str(port)] = now + self.ttl
+            with open(self.path, 'w') as f:
+                json.dump(reserved, f)
+
+        return ports
+
+
+def wait_http_service(port, path='/', timeout=30):
+    """Wait until an HTTP GET of path on a local port returns 200.
+
+    Docker's port proxy accepts connections before the service in the
+    container is up, so a successful connect alone does not mean ready.
+    Retries back off from 50 ms to 1 s. Returns whether the service
+    became ready within timeout seconds.
     """
-    import socket
 
-    for _ in range(timeout * 10):
+    deadline = time.time() + timeout
+    delay = 0.05
+    while True:
+        conn = httplib.HTTPConnection('127.0.0.1', int(port), timeout=5)
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect(("127.0.0.1", port))
-        except socket.error:
-            sock.close()
-            time.sleep(0.1)
-            continue
-        else:
-            sock.close()
-            time.sleep(3)
-            return True
+            conn.request('GET', path)
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status == 200:
+                return True
+        except (socket.error, httplib.HTTPException):
+            pass
+        finally:
+            conn.close()
 
+        if time.time() + delay > deadline:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 1.0)
+
+
+def native_resolution():
+    """Ask the display server for the screen size, such as 1920x1080.
+
+    Uses the Windows API, CoreGraphics on macOS, and Xlib or xrandr on X11.
+    Returns "" if none of them answers.
+    """
+    import ctypes
+    import ctypes.util
+    import platform
+    import re
 
-def get_screen_resolution():
-    """Obtain the local screen resolution."""
+    def load(*names):
+        for name in names:
+            if name:
+                try:
+                    return ctypes.cdll.LoadLibrary(name)
+                except OSError:
+                    pass
+        return None
 
+    system = platform.system()
     try:
-        if sys.version_info.major > 2:
-            import tkinter as tk
-        else:
-            import Tkinter as tk
+        if system == 'Windows':
+            user32 = ctypes.windll.user32
+            # Report physical pixels rather than scaled ones
+            user32.SetProcessDPIAware()
+            return '%dx%d' % (user32.GetSystemMetrics(0),
+                              user32.GetSystemMetrics(1))
 
-        root = tk.Tk()
-        root.withdraw()
-        width, height = root.winfo_screenwidth(), root.winfo_screenheight()
+        if system == 'Darwin':
+            cg = load(ctypes.util.find_library('CoreGraphics'))
+            if not cg:
+                return ''
+            cg.CGMainDisplayID.restype = ctypes.c_uint32
+            for func in (cg.CGDisplayPixelsWide, cg.CGDisplayPixelsHigh):
+                func.argtypes = [ctypes.c_uint32]
+                func.restype = ctypes.c_size_t
+            display = cg.CGMainDisplayID()
+            return '%dx%d' % (cg.CGDisplayPixelsWide(display),
+                              cg.CGDisplayPixelsHigh(display))
 
-        return str(width) + 'x' + str(height)
-    except:
-        return ""
+        if not os.environ.get('DISPLAY'):
+            return ''
 
+        xlib = load('libX11.so.6', ctypes.util.find_library('X11'))
+        if xlib:
+            xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+            xlib.XOpenDisplay.restype = ctypes.c_void_p
+            xlib.XDefaultScreen.argtypes = [ctypes.c_void_p]
+            xlib.XDisplayWidth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+            xlib.XDisplayHeight.argtypes = [ctypes.c_void_p, ctypes.c_int]
+            xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+            display = xlib.XOpenDisplay(None)
+            if display:
+                screen = xlib.XDefaultScreen(display)
+                size = '%dx%d' % (xlib.XDisplayWidth(display, screen),
+                                  xlib.XDisplayHeight(display, screen))
+                xlib.XCloseDisplay(display)
+                return size
+    except (OSError, AttributeError, ValueError):
+        pass
 
-def handle_interrupt(container):
-    """Handle keyboard interrupt"""
     try:
-        print("Press Ctrl-C again to stop the server: ")
-        time.sleep(5)
-        print('Invalid response. Resuming...')
-    except KeyboardInterrupt:
-        print('*** Stopping the server.')
-        subprocess.Popen(["docker", "exec", container,
-                          "killall", "my_init"],
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        sys.exit(0)
+        with open(os.devnull, 'w') as devnull:
+            out = subprocess.check_output(['xrandr', '--current'],
+                                          stderr=devnull)
+        m = re.search(r'current (\d+) x (\d+)', out.decode('utf-8'))
+        if m:
+            return m.group(1) + 'x' + m.group(2)
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return ''
 
 
-if __name__ == "__main__":
-    import webbrowser
-    import platform
-    import glob
+def tk_resolution():
+    """Ask Tk for the screen size, or return "" if Tk fails.
 
-    args = parse_args(description=__doc__)
-    config = proj + '_' + args.tag + '_config'
+    Tk runs in a child process, since creating a window takes a while and
+    must be done in the main thread on macOS.
+    """
+    import re
 
-    if args.quiet:
-        def print(*args, **kwargs):
-            "Do nothing"
-            pass
+    code = ('try:\n    import tkinter as tk\n'
+            'except ImportError:\n    import Tkinter as tk\n'
+            'root = tk.Tk()\nroot.withdraw()\n'
+            'print("%dx%d" % (root.winfo_screenwidth(), '
+            'root.winfo_screenheight()))\n')
+    try:
+        with open(os.devnull, 'w') as devnull:
+            out = subprocess.check_output([sys.executable, '-c', code],
+                                          stderr=devnull).decode('utf-8')
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+    return out.strip() if re.match(r'^\d+x\d+$', out.strip()) else ''
 
-        def stdout_write(*args, **kwargs):
-            "Do nothing"
-            pass
 
-        def stderr_write(*args, **kwargs):
-            "Do nothing"
-            pass
-    else:
-        def stdout_write(*args, **kwargs):
-            "Call sys.stderr.write"
-            sys.stdout.write(*args, **kwargs)
+def get_screen_resolution(path=None):
+    """Obtain the local screen resolution.
 
-        def stderr_write(*args, **kwargs):
-            "Call sys.stderr.write"
-            sys.stderr.write(*args, **kwargs)
+    $SCREEN_RESOLUTION, such as 1920x1080, overrides it. Otherwise the
+    display server is asked directly, and only if that fails is Tk used.
+    Tk is slow to start, so its answer is cached per display in the state
+    directory, and later launches use the cached size while a background
+    thread asks Tk again. Returns "" on a host without a screen.
+    """
+    import json
+    import re
 
-    pwd = os.getcwd()
-    homedir = os.path.expanduser('~')
-    if platform.system() == "Linux":
-        if subprocess.check_output(['groups']).find(b'docker') < 0:
-            print('You are not a member of the docker group. Please add')
-            print('yourself to the docker group using the following command:')
-            print('   sudo addgroup $USER docker')
-            print('Then, log out and log back in before you can use Docker.')
-            sys.exit(-1)
-        uid = str(os.getuid())
-        if uid == '0':
-            print('You are running as root. This is not safe. ' +
-                  'Please run as a regular user.')
-            sys.exit(-1)
-    else:
-        uid = ""
+    size = os.environ.get('SCREEN_RESOLUTION', '').strip()
+    if re.match(r'^\d+x\d+$', size):
+        return size
+
+    size = native_resolution()
+    if size:
+        return size
 
+    if sys.platform not in ('win32', 'cygwin', 'darwin') and \
+            not os.environ.get('DISPLAY'):
+        # Headless, so Tk would fail as well
+        return ''
+
+    key = os.environ.get('DISPLAY') or sys.platform
+    path = path or state_path('screen.json')
     try:
-        if args.verbose:
-            stdout_write("Check whether Docker is up and running.\n")
-        img = subprocess.check_output(['docker', 'images', '-q', args.image])
-    except:
-        stderr_write("Docker failed. Please make sure docker was properly " +
-                     "installed and has been started.\n")
-        sys.exit(-1)
+        with open(path) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
 
-    if args.pull or not img:
-        try:
-            if args.verbose:
-                stdout_write("Pulling latest docker image " +
-                             args.image + '.\n')
-            err = subprocess.call(["docker", "pull", args.image])
-        except BaseException:
-            err = -1
+    def refresh():
+        size = tk_resolution()
+        if size and cache.get(key) != size:
+            with FileLock(path + '.lock'):
+                cache[key] = size
+                with open(path, 'w') as f:
+                    json.dump(cache, f)
+        return size
 
-        if err:
-            sys.exit(err)
+    if key not in cache:
+        return refresh()
 
-        # Delete dangling image
-        if img and subprocess.check_output(['docker', 'images', '-f',
-                                            'dangling=true',
-                                            '-q']).find(img) >= 0:
-            subprocess.Popen(["docker", "rmi", "-f", img.decode('utf-8')[:-1]])
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+    return cache[key]
 
-    docker_user = "ubuntu"
-    docker_home = "/home/" + docker_user
 
-    if args.reset:
-        try:
-            if args.verbose:
-                stdout_write("Removing old docker volume " + config + ".\n")
-            output = subprocess.check_output(
-                ["docker", "volume", "rm", "-f", config])
-        except subprocess.CalledProcessError as e:
-            stderr_write(e.output.decode('utf-8'))
+class DockerError(subprocess.CalledProcessError):
+    """A Docker request failed.
 
-    volumes = ["-v", pwd + ":" + docker_home + "/shared",
-               "-v", config + ":" + docker_home + "/.config"]
+    It derives from CalledProcessError so that callers handle errors from
+    the Engine API and from the docker command-line client the same way.
+    """
 
-    if os.path.exists(homedir + "/.gnupg"):
-        volumes += ["-v", homedir + "/.gnupg" +
-                    ":" + docker_home + "/.gnupg"]
+    def __init__(self, status, cmd, output=b''):
+        subprocess.CalledProcessError.__init__(self, status, cmd, output)
 
-    # Mount .gitconfig to Docker image
-    if os.path.isfile(homedir + "/.gitconfig"):
-        volumes += ["-v", homedir + "/.gitconfig" +
-                    ":" + docker_home + "/.gitconfig_host"]
+    def __str__(self):
+        return 'Docker request %s failed (%s): %s' % \
+            (self.cmd, self.returncode,
+             self.output.decode('utf-8', 'replace').strip())
 
-    if args.volume:
-        if args.clear:
-            try:
-                if args.verbose:
-                    stdout_write(
-                        "Removing old docker volume " + config + ".\n")
-                output = subprocess.check_output(["docker", "volume",
-                                                  "rm", "-f", args.volume])
-            except subprocess.CalledProcessError as e:
-                stderr_write(e.output.decode('utf-8'))
 
-        volumes += ["-v", args.volume + ":" + docker_home + "/" + projdir]
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """HTTP connection over a Unix domain socket"""
 
-    if args.workdir[0] == '/':
-        volumes += ["-w", args.workdir]
-    else:
-        volumes += ["-w", docker_home + "/" + args.workdir]
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.unix_path = path
 
-    stderr_write("Starting up docker image...\n")
-    if subprocess.check_output(["docker", "--version"]). \
-            find(b"Docker version 1.") >= 0:
-        rmflag = "-t"
-    else:
-        rmflag = "--rm"
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
 
-    # Determine size of the desktop
-    if not args.size:
-        size = get_screen_resolution()
-        if not size:
-            # Set default size and disable webbrowser
-            size = "1440x900"
-            args.no_browser = True
-    else:
-        size = args.size
 
-    # Generate a container ID
-    container = id_generator()
+class LineStream(object):
+    """Line reader over a Docker output stream.
 
-    envs = ["--hostname", container,
-            "--env", "RESOLUT=" + size,
-            "--env", "HOST_UID=" + uid]
+    Docker multiplexes stdout and stderr of containers without a tty into
+    frames with an 8-byte header. This class strips the headers and
+    returns the payload line by line.
+    """
 
-    # Find a free port for ssh tunning
-    port_ssh = str(find_free_port(2222, 50))
-    if not port_ssh:
-        stderr_write("Error: Could not find a free port.\n")
-        sys.exit(-1)
-    envs += ["-p", port_ssh + ":22"]
+    def __init__(self, resp, conn, multiplexed=True):
+        self.resp = resp
+        self.conn = conn
+        self.multiplexed = multiplexed
+        self.buf = b''
+        self.eof = False
 
-    # Create directory .ssh if not exist
-    if not os.path.exists(homedir + "/.ssh"):
-        os.mkdir(homedir + "/.ssh")
+    def _read(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.resp.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
 
-    volumes += ["-v", homedir + "/.ssh" + ":" + docker_home + "/.ssh"]
+    def _fill(self):
+        import struct
 
-    devices = []
-    if args.nvidia:
-        for d in glob.glob('/dev/nvidia*'):
-            devices += ['--device', d + ':' + d]
+        if not self.multiplexed:
+            chunk = self.resp.read1(4096) if hasattr(self.resp, 'read1') \
+                else self.resp.read(1)
+            if not chunk:
+                self.eof = True
+            self.buf += chunk
+            return
 
-    # Start the docker image in the background and pipe the stderr
-    port_http = str(find_free_port(6080, 50))
-    port_vnc = str(find_free_port(5950, 50))
+        header = self._read(8)
+        if len(header) < 8:
+            self.eof = True
+            return
+        size = struct.unpack('>I', header[4:])[0]
+        self.buf += self._read(size)
 
-    if not port_http or not port_vnc:
-        stderr_write("Error: Could not find a free port.\n")
-        sys.exit(-1)
+    def readline(self):
+        "Return the next line, or an empty string at the end of the stream"
+        while b'\n' not in self.buf and not self.eof:
+            try:
+                self._fill()
+            except (socket.error, httplib.HTTPException, ValueError):
+                self.eof = True
 
-    cmd = ["docker", "run", "-d", rmflag, "--name", container,
-                     "--shm-size", "2g", "-p", port_http + ":6080",
-                     "-p", port_vnc + ":5900"] + \
-        envs + volumes + devices + args.args.split() + \
-        ['--security-opt', 'seccomp=unconfined', '--cap-add=SYS_PTRACE',
-         args.image, "startvnc.sh >> " +
-         docker_home + "/.log/vnc.log"]
+        ind = self.buf.find(b'\n')
+        if ind < 0:
+            line, self.buf = self.buf, b''
+        else:
+            line, self.buf = self.buf[:ind + 1], self.buf[ind + 1:]
+        return line.decode('utf-8', 'replace').replace('\r\n', '\n')
 
-    if args.verbose:
-        stdout_write(' '.join(cmd[:-1]) + ' "' + cmd[-1] + '"\n')
+    def close(self):
+        "Close the underlying connection"
+        try:
+            self.conn.close()
+        except (socket.error, httplib.HTTPException):
+            pass
 
-    subprocess.call(cmd)
 
-    wait_for_url = True
+class ExecPipe(LineStream):
+    """Pipe to the stdin and stdout of a command in a container.
 
-    # Wait for user to press Ctrl-C
-    while True:
+    Writes go to the hijacked socket of the exec, and reads strip the
+    frame headers of its output like LineStream.
+    """
+
+    def __init__(self, resp, conn, sock):
+        LineStream.__init__(self, resp, conn)
+        self.sock = sock
+
+    def write(self, data):
+        "Write a string to the stdin of the command"
+        self.sock.sendall(data.encode('utf-8'))
+
+    def close(self):
+        "Close the stdin of the command and the connection"
         try:
-            if wait_for_url:
-                # Wait until the file is not empty
-                while not subprocess.check_output(["docker", "exec", container,
-                                                   "cat", docker_home +
-                                                   "/.log/vnc.log"]):
-                    time.sleep(1)
+            self.sock.shutdown(socket.SHUT_WR)
+            self.sock.close()
+        except socket.error:
+            pass
+        LineStream.close(self)
 
-                p = subprocess.Popen(["docker", "exec", container,
-                                      "tail", "-F",
-                                      docker_home + "/.log/vnc.log"],
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE,
-                                     universal_newlines=True)
 
-                # Monitor the stdout to extract the URL
-                for stdout_line in iter(p.stdout.readline, ""):
-                    ind = stdout_line.find("http://localhost:")
+class ProcessStream(object):
+    """Line reader over the stdout of a docker command"""
 
-                    if ind >= 0:
-                        # Open browser if found URL
-                        url = stdout_line.replace(":6080/",
-                                                  ':' + port_http + "/")
-                        stdout_write(url)
+    def __init__(self, proc):
+        self.proc = proc
 
-                        passwd = stdout_line[url.find('password=') + 9:]
-                        stdout_write("\nFor a better experience, use VNC Viewer (" +
-                                     'http://realvnc.com/download/viewer)\n' +
-                                     "to connect to localhost:%s with password %s\n" %
-                                     (port_vnc, passwd))
+    def readline(self):
+        "Return the next line, or an empty string at the end of the stream"
+        return self.proc.stdout.readline()
 
-                        stdout_write("You can also log into the container using the command\n    ssh -X -p " + port_ssh + " " +
-                                     docker_user + "@localhost -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no\n" +
-                                     "with an authorized key in " +
-                                     homedir + "/.ssh/authorized_keys.\n")
+    def write(self, data):
+        "Write a string to the stdin of the command"
+        self.proc.stdin.write(data)
+        self.proc.stdin.flush()
 
-                        if not args.no_browser:
-                            wait_net_service(int(port_http))
-                            webbrowser.open(url[ind:-1])
+    def close(self):
+        "Close the pipes and terminate the process"
+        if self.proc.stdin:
+            self.proc.stdin.close()
+        self.proc.stdout.close()
+        self.proc.terminate()
 
-                        p.stdout.close()
-                        p.terminate()
-                        wait_for_url = False
-                        break
-                    else:
-                        stdout_write(stdout_line)
+
+def run_command(spec):
+    """Build the "docker run" command line for a container spec.
+
+    The spec is a dict with the keys image, name, hostname, command, env,
+    ports, binds, workdir, devices, shm_size, cpus, memory, cpuset,
+    log_opts, remove, security_opt, cap_add, extra_args, labels and
+    profile_env. cpus, memory, cpuset and log_opts are None for no limit. profile_env is not
+    used by docker run; see run_container.
+    """
+
+    cmd = ["docker", "run", "-d", "--rm" if spec['remove'] else "-t",
+           "--name", spec['name'], "--shm-size", spec['shm_size']]
+    if spec['cpus']:
+        cmd += ["--cpus", spec['cpus']]
+    if spec['memory']:
+        cmd += ["--memory", str(spec['memory'])]
+    if spec['cpuset']:
+        cmd += ["--cpuset-cpus", spec['cpuset']]
+    for key in sorted(spec['log_opts'] or {}):
+        cmd += ["--log-opt", key + '=' + spec['log_opts'][key]]
+    for host_port, port in spec['ports']:
+        cmd += ["-p", host_port + ":" + port]
+    cmd += ["--hostname", spec['hostname']]
+    for env in spec['env']:
+        cmd += ["--env", env]
+    for bind in spec['binds']:
+        cmd += ["-v", bind]
+    cmd += ["-w", spec['workdir']]
+    for dev in spec['devices']:
+        cmd += ['--device', dev + ':' + dev]
+    cmd += spec['extra_args']
+    for opt in spec['security_opt']:
+        cmd += ['--security-opt', opt]
+    for cap in spec['cap_add']:
+        cmd += ['--cap-add=' + cap]
+    for key in sorted(spec['labels']):
+        cmd += ['--label', key + '=' + spec['labels'][key]]
+
+    return cmd + [spec['image'], spec['command']]
+
+
+def parse_size(size):
+    "Convert a size such as 2g or 512m into bytes"
+
+    units = {'b': 1, 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30, 't': 1 << 40}
+    size = size.strip().lower().rstrip('ib')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def split_image(image):
+    "Split an image reference into repository and tag"
+
+    ind = image.rfind(':')
+    if ind > image.rfind('/'):
+        return image[:ind], image[ind + 1:]
+    return image, 'latest'
+
+
+class Registry(object):
+    """Client for the manifests of an image in a Docker registry.
+
+    It speaks the registry v2 API and gets an anonymous bearer token when
+    the registry asks for one, as Docker Hub does. Registries on localhost,
+    such as a local registry:2 container, are reached over plain HTTP.
+    """
+
+    manifest_types = ['application/vnd.docker.distribution.manifest.list.v2+json',
+                      'application/vnd.oci.image.index.v1+json',
+                      'application/vnd.docker.distribution.manifest.v2+json',
+                      'application/vnd.oci.image.manifest.v1+json']
+
+    def __init__(self, image, timeout=10):
+        repo, self.tag = split_image(image)
+        host = repo.split('/')[0]
+        if '/' in repo and ('.' in host or ':' in host or host == 'localhost'):
+            self.host, self.repo = host, repo[len(host) + 1:]
+        else:
+            self.host = 'registry-1.docker.io'
+            self.repo = repo if '/' in repo else 'library/' + repo
+        self.secure = host.split(':')[0] not in ('localhost', '127.0.0.1')
+        self.timeout = timeout
+        self.token = None
+
+    def _connection(self, host, secure):
+        if secure:
+            return httplib.HTTPSConnection(host, timeout=self.timeout)
+        return httplib.HTTPConnection(host, timeout=self.timeout)
+
+    def _authenticate(self, challenge):
+        "Get a bearer token for the challenge of a 401 response"
+        import json
+        import re
+        try:
+            from urllib.parse import urlencode, urlparse
+        except ImportError:
+            from urllib import urlencode
+            from urlparse import urlparse
+
+        if not challenge.lower().startswith('bearer '):
+            raise RuntimeError('Unsupported registry authentication: ' +
+                               challenge)
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = urlparse(params.pop('realm'))
+        conn = self._connection(realm.netloc, realm.scheme == 'https')
+        try:
+            conn.request('GET', realm.path + '?' + urlencode(params))
+            resp = conn.getresponse()
+            body = resp.read()
+        finally:
+            conn.close()
+        if resp.status != 200:
+            raise RuntimeError('Registry token request failed with status %d' %
+                               resp.status)
+        reply = json.loads(body.decode('utf-8'))
+        self.token = reply.get('token') or reply['access_token']
+
+    def _manifest(self, method, reference, accept):
+        "Request a manifest and return the response and its body"
+
+        for _ in range(2):
+            headers = {'Accept': ', '.join(accept)}
+            if self.token:
+                headers['Authorization'] = 'Bearer ' + self.token
+            conn = self._connection(self.host, self.secure)
+            try:
+                conn.request(method, '/v2/' + self.repo + '/manifests/' +
+                             reference, headers=headers)
+                resp = conn.getresponse()
+                body = resp.read()
+            finally:
+                conn.close()
+            if resp.status == 401 and not self.token:
+                self._authenticate(resp.getheader('WWW-Authenticate', ''))
+                continue
+            break
+
+        if resp.status != 200:
+            raise RuntimeError('Registry %s returned status %d for %s:%s' %
+                               (self.host, resp.status, self.repo, reference))
+        return resp, body
+
+    def digest(self):
+        """Return the digest of the manifest of the tag.
+
+        It uses a HEAD request, which Docker Hub does not count as a pull.
+        """
+        resp, _ = self._manifest('HEAD', self.tag, self.manifest_types)
+        digest = resp.getheader('Docker-Content-Digest')
+        if not digest:
+            raise RuntimeError('Registry ' + self.host + ' sent no digest')
+        return digest
+
+    def download_size(self):
+        """Return the compressed size of the image for this platform.
+
+        Layers that are already local are not downloaded again, so this
+        is an upper bound of the bytes a pull transfers.
+        """
+        import json
+        import platform
+
+        arch = {'x86_64': 'amd64', 'aarch64': 'arm64'}.get(
+            platform.machine().lower(), platform.machine().lower())
+
+        _, body = self._manifest('GET', self.tag, self.manifest_types)
+        manifest = json.loads(body.decode('utf-8'))
+        if 'manifests' in manifest:
+            # A multi-platform image lists one manifest per platform
+            for entry in manifest['manifests']:
+                if entry.get('platform', {}).get('architecture') == arch and \
+                        entry['platform'].get('os') == 'linux':
+                    break
+            else:
+                raise RuntimeError('Image has no manifest for linux/' + arch)
+            _, body = self._manifest('GET', entry['digest'],
+                                     self.manifest_types[2:])
+            manifest = json.loads(body.decode('utf-8'))
+
+        return manifest['config']['size'] + \
+            sum(layer['size'] for layer in manifest['layers'])
+
+
+def format_size(size):
+    "Format a number of bytes for humans"
+
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024.0
+    return ('%d %s' if unit == 'B' else '%.1f %s') % (size, unit)
+
+
+def pull_needed(image, digests, verbose=False):
+    """Tell whether a pull would change the local copy of an image.
+
+    digests are the repo digests of the local image. They are compared
+    with the digest of the manifest in the registry. If a pull is needed,
+    the bytes it would transfer are printed. If the registry cannot be
+    asked, a pull is assumed to be needed.
+    """
+
+    try:
+        registry = Registry(image)
+        digest = registry.digest()
+        if digest in digests:
+            if verbose:
+                stdout_write("Image " + image + " is up to date (" +
+                             digest + ").\n")
+            return False
+        stdout_write("Pulling " + image + " transfers up to " +
+                     format_size(registry.download_size()) + ".\n")
+    except (socket.error, httplib.HTTPException, RuntimeError,
+            ValueError, KeyError) as e:
+        stderr_write("Warning: Could not check the registry for " + image +
+                     ": " + str(e) + "\n")
+    return True
+
+
+def pull_in_background(docker, image):
+    """Pull an image while the launcher goes on with the current image.
+
+    Docker stops a pull when its client goes away, so the pull runs in a
+    detached process that loads this launcher and pulls with the same
+    backend. It goes on if the launcher exits or Ctrl-C stops it. If no
+    process can be started, a thread does the pull and the launcher waits
+    for it before exiting.
+    """
+
+    program = ('import sys\n'
+               'path, backend, image = sys.argv[1:]\n'
+               'launcher = {"__name__": "pull", "__file__": path}\n'
+               'with open(path) as f:\n'
+               '    exec(compile(f.read(), path, "exec"), launcher)\n'
+               'launcher["stdout_write"] = lambda *args: None\n'
+               'launcher["stderr_write"] = lambda *args: None\n'
+               'launcher["docker_client"](backend).pull(image)\n')
+    backend = 'api' if isinstance(docker, DockerAPI) else 'cli'
+    # A session of its own keeps Ctrl-C in the terminal from reaching it
+    detach = getattr(os, 'setsid', None)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.Popen([sys.executable, '-c', program,
+                              os.path.abspath(__file__), backend, image],
+                             stdin=devnull, stdout=devnull, stderr=devnull,
+                             preexec_fn=detach)
+    except OSError:
+        threading.Thread(target=docker.pull, args=(image,)).start()
+
+
+def record_image_use(image, path=None):
+    """Record that a launch used an image tag now.
+
+    The times are kept in a locked file in the state directory, so that
+    the garbage collector can evict the least recently used tags.
+    """
+    import json
+
+    path = path or state_path('images.json')
+    with FileLock(path + '.lock'):
+        try:
+            with open(path) as f:
+                used = json.load(f)
+        except (IOError, ValueError):
+            used = {}
+        used['%s:%s' % split_image(image)] = time.time()
+        with open(path, 'w') as f:
+            json.dump(used, f)
+
+
+def collect_images(docker, image, budget, dry_run=False, path=None):
+    """Remove old tags of an image until its repository fits in a budget.
+
+    Tags are removed least recently used first, by the launch times kept
+    in the state directory. Tags that were never launched go first. Images of
+    running containers and images that are also tagged in another
+    repository are kept. Returns whether the repository fits in budget
+    bytes afterwards.
+    """
+    import json
+
+    repo = split_image(image)[0]
+    path = path or state_path('images.json')
+    try:
+        with open(path) as f:
+            used = json.load(f)
+    except (IOError, ValueError):
+        used = {}
+
+    in_use = set(info['Image'] for info in docker.containers())
+    images = docker.images(repo)
+    total = sum(img['Size'] for img in images)
+    stdout_write("Images of %s use %s of a budget of %s.\n" %
+                 (repo, format_size(total), format_size(budget)))
+
+    def last_used(img):
+        return max([used.get(t, 0) for t in img['RepoTags']] or [0])
+
+    removed = []
+    for img in sorted(images, key=last_used):
+        if total <= budget:
+            break
+        tags = img['RepoTags'] or []
+        if img['Id'] in in_use or \
+                any(split_image(t)[0] != repo for t in tags):
+            continue
+
+        when = last_used(img)
+        stdout_write("Removing %s (%s, last used %s).\n" %
+                     (', '.join(tags) or img['Id'][:19], format_size(img['Size']),
+                      time.strftime('%Y-%m-%d %H:%M', time.localtime(when))
+                      if when else 'never'))
+        if not dry_run:
+            try:
+                for t in tags or [img['Id']]:
+                    docker.remove_tag(t)
+            except subprocess.CalledProcessError as e:
+                # For example, a stopped container still uses the image
+                stderr_write("Could not remove %s: %s\n" % (t, e))
+                continue
+        removed += tags
+        total -= img['Size']
+
+    if removed and not dry_run:
+        with FileLock(path + '.lock'):
+            try:
+                with open(path) as f:
+                    used = json.load(f)
+            except (IOError, ValueError):
+                used = {}
+            for t in removed:
+                used.pop(t, None)
+            with open(path, 'w') as f:
+                json.dump(used, f)
+
+    stdout_write("Images of %s %s %s.\n" %
+                 (repo, 'would use' if dry_run else 'now use',
+                  format_size(total)))
+    return total <= budget
+
+
+def parse_cpuset(cpuset):
+    "Convert a cpuset such as 0-3,8 into a list of CPUs"
+
+    cpus = []
+    for part in cpuset.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus += range(int(first), int(last) + 1)
+        elif part.strip():
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpuset(cpus):
+    "Convert a list of CPUs into a cpuset such as 0-3,8"
+
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(a) if a == b else '%d-%d' % (a, b) for a, b in ranges)
+
+
+def numa_nodes(ncpu):
+    """Return the CPUs of each NUMA node of the Docker host.
+
+    The nodes are only visible if Docker runs on this Linux host. Otherwise,
+    all CPUs are returned as one node.
+    """
+    import glob
+    import multiprocessing
+    import platform
+
+    nodes = []
+    if platform.system() == 'Linux' and multiprocessing.cpu_count() == ncpu:
+        for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'),
+                           key=lambda p: int(p.split('/')[-2][4:])):
+            with open(path) as f:
+                nodes.append([cpu for cpu in parse_cpuset(f.read().strip())
+                              if cpu < ncpu])
+    return [node for node in nodes if node] or [list(range(ncpu))]
+
+
+def choose_cpuset(nodes, k, load):
+    """Choose k CPUs for a session.
+
+    load has the number of sessions pinned to each CPU. The k CPUs with
+    the least total load are chosen among runs of CPUs in node order,
+    preferring runs that stay within fewer NUMA nodes, so that sessions
+    do not share caches or memory controllers while there is room.
+    """
+
+    order = [cpu for node in nodes for cpu in node]
+    node_of = dict((cpu, i) for i, node in enumerate(nodes) for cpu in node)
+    k = max(1, min(k, len(order)))
+
+    best = None
+    for start in range(len(order) - k + 1):
+        run = order[start:start + k]
+        key = (sum(load.get(cpu, 0) for cpu in run),
+               len(set(node_of[cpu] for cpu in run)), start)
+        if best is None or key < best[0]:
+            best = (key, run)
+    return sorted(best[1])
+
+
+def thread_env(threads):
+    "Return the environment that limits OpenMP, BLAS and PETSc to threads"
+
+    return ['%s=%d' % (var, threads) for var in
+            ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+             'NUMEXPR_NUM_THREADS')] + \
+        ['PETSC_OPTIONS=-omp_num_threads %d' % threads]
+
+
+def mpi_env(threads):
+    """Return the Open MPI settings for ranks within one container.
+
+    Ranks only talk through shared memory, so the network transports are
+    turned off. Ranks are bound to cores if each runs a single thread.
+    """
+
+    return ['OMPI_MCA_btl=vader,self',
+            'OMPI_MCA_btl_base_warn_component_unused=0',
+            'OMPI_MCA_hwloc_base_binding_policy=' +
+            ('core' if threads == 1 else 'none')]
+
+
+def mpi_self_test(docker, container, size=1 << 22):
+    """Measure MPI latency and bandwidth between two ranks in a container.
+
+    A ping-pong of mpi4py runs as the container user in a login shell,
+    with the same environment as a terminal. The two ranks may share a
+    CPU, so the test also runs in a container with one CPU. Returns the
+    latency in microseconds and the bandwidth in MB/s for messages of
+    size bytes.
+    """
+
+    script = '\n'.join([
+        'from mpi4py import MPI',
+        'import numpy as np',
+        'comm = MPI.COMM_WORLD',
+        'def pingpong(n, reps):',
+        '    buf = np.zeros(n, "b")',
+        '    comm.Barrier()',
+        '    start = MPI.Wtime()',
+        '    for _ in range(reps):',
+        '        if comm.rank == 0:',
+        '            comm.Send(buf, 1)',
+        '            comm.Recv(buf, 1)',
+        '        elif comm.rank == 1:',
+        '            comm.Recv(buf, 0)',
+        '            comm.Send(buf, 0)',
+        '    return (MPI.Wtime() - start) / reps / 2',
+        'pingpong(1, 10)',
+        'latency = pingpong(1, 1000)',
+        'seconds = pingpong(%d, 20)' % size,
+        'if comm.rank == 0:',
+        '    print("pingpong %%g %%g" %% (latency * 1e6, %d / seconds / 1e6))' % size,
+        ''])
+    path = '/tmp/' + proj + '_pingpong.py'
+
+    out = docker.exec_output(container, [
+        'sh', '-c', 'printf %s "$0" > ' + path + ' && chmod a+r ' + path +
+        ' && su - ' + docker_user +
+        ' -c "mpirun --oversubscribe -np 2 python3 ' + path + '"',
+        script]).decode('utf-8')
+    for line in out.split('\n'):
+        if line.startswith('pingpong '):
+            latency, bandwidth = line.split()[1:]
+            return float(latency), float(bandwidth)
+    raise DockerError(-1, 'mpirun', out.encode('utf-8'))
+
+
+def report_mpi_test(docker, container):
+    "Run mpi_self_test and print its result or error"
+
+    try:
+        latency, bandwidth = mpi_self_test(docker, container)
+        stdout_write("MPI self-test: latency %.2f us, bandwidth %.0f MB/s.\n" %
+                     (latency, bandwidth))
+    except subprocess.CalledProcessError as e:
+        stderr_write("MPI self-test failed:\n" +
+                     (e.output or b'').decode('utf-8'))
+
+
+def measure_client_link():
+    """Return the round-trip time and bandwidth of the link to the browser.
+
+    A launch over ssh serves the browser on the ssh client, and the kernel
+    keeps the smoothed round-trip time and the delivery rate of the ssh
+    connection, which ss -ti shows. An idle connection delivers less than
+    the link can, so the bandwidth is the larger of the delivery rate and
+    the rate that the congestion window allows. Returns the seconds and
+    the bytes per second, (0, None) without $SSH_CONNECTION, since the
+    browser then runs on this host, or None if ss does not show the link.
+    """
+    import re
+
+    client = os.environ.get('SSH_CONNECTION', '').split()
+    if len(client) != 4:
+        return 0, None
+    try:
+        out = subprocess.check_output(['ss', '-tin'], stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    units = {'': 1, 'K': 1e3, 'M': 1e6, 'G': 1e9}
+    found = False
+    for line in out.decode('utf-8', 'replace').split('\n'):
+        if not line[:1].isspace():
+            # State, Recv-Q, Send-Q, local address and peer address
+            fields = line.split()
+            found = (len(fields) >= 5 and
+                     fields[3].endswith(':' + client[3]) and
+                     client[0] in fields[4] and
+                     fields[4].endswith(':' + client[1]))
+        elif found:
+            rtt = re.search(r'\brtt:([\d.]+)', line)
+            rates = [float(n) * units[u] / 8 for n, u in re.findall(
+                r'\b(?:delivery_rate|send) ([\d.]+)([KMG]?)bps', line)]
+            if rtt and rates:
+                return float(rtt.group(1)) / 1000, max(rates)
+    return None
+
+
+def describe_link(link):
+    "Describe the link that measure_client_link returned, for a report"
+
+    if link is None:
+        return 'ss does not show the link to the browser.'
+    if link[1] is None:
+        return 'The browser runs on this host.'
+    return 'Link to the browser: %.1f ms round trip, %s/s.' % (
+        link[0] * 1000, format_size(link[1]))
+
+
+# (minimum bandwidth in bytes/s, quality, compression) from the fastest link
+# down. Slow links trade image quality and CPU time for fewer bytes.
+VNC_TIERS = [(8 << 20, 8, 1),
+             (1 << 20, 6, 3),
+             (256 << 10, 4, 6),
+             (0, 2, 9)]
+
+
+def choose_vnc_settings(rtt, rate):
+    """Pick the quality and compression for a link.
+
+    A rate of None is a browser on this host, which gets the fastest tier.
+    Links with a round-trip time above 100 ms get the next slower tier,
+    since fewer bytes per frame keep less of the screen in flight.
+    """
+
+    tier = 0
+    while rate is not None and rate < VNC_TIERS[tier][0]:
+        tier += 1
+    if rtt > 0.1:
+        tier = min(tier + 1, len(VNC_TIERS) - 1)
+    return {'quality': VNC_TIERS[tier][1], 'compression': VNC_TIERS[tier][2]}
+
+
+def auto_vnc_settings(args):
+    """Return the VNC settings of the options, measuring the link for auto.
+
+    Settings that are not given are None, so noVNC uses its defaults. The
+    choice for auto is printed with the link it was made for. If the link
+    cannot be measured, the auto settings are None as well.
+    """
+
+    settings = {'quality': args.vnc_quality,
+                'compression': args.vnc_compression}
+    if 'auto' in settings.values():
+        link = measure_client_link()
+        if link is None:
+            stderr_write("Warning: ss does not show the ssh connection, so " +
+                         "noVNC keeps its defaults for the auto settings.\n")
+            auto = {'quality': None, 'compression': None}
+        else:
+            auto = choose_vnc_settings(*link)
+            stdout_write(describe_link(link) + ' Using Tight encoding with ' +
+                         'quality %d and compression %d.\n' %
+                         (auto['quality'], auto['compression']))
+        settings = dict((k, auto[k] if v == 'auto' else v)
+                        for k, v in settings.items())
+    return dict((k, int(v) if v is not None else None)
+                for k, v in settings.items())
+
+
+def novnc_settings(port_http, timeout):
+    """Return the URL settings that the noVNC of the image reads.
+
+    noVNC reads quality and compression since 1.2. The settings are looked
+    up in the ui.js of noVNC, which is app/ui.js since 0.6 and include/ui.js
+    before. Returns None if noVNC does not respond.
+    """
+
+    if not wait_http_service(port_http, '/vnc.html', timeout):
+        return None
+    for path in ('/app/ui.js', '/include/ui.js'):
+        conn = httplib.HTTPConnection('127.0.0.1', int(port_http),
+                                      timeout=30)
+        try:
+            conn.request('GET', path)
+            resp = conn.getresponse()
+            if resp.status == 200:
+                script = resp.read().decode('utf-8', 'replace')
+                return set(key for key in ('quality', 'compression')
+                           if "'%s'" % key in script)
+        except (socket.error, httplib.HTTPException):
+            pass
+        finally:
+            conn.close()
+    return set()
+
+
+def vnc_settings(args, port_http):
+    """Return the VNC settings of the options that noVNC supports.
+
+    auto_vnc_settings resolves auto. The Dockerfile installs noVNC 1.2,
+    but an image from elsewhere may have an older one, so settings that
+    its noVNC does not read are dropped with a warning, since noVNC would
+    ignore them without one.
+    """
+
+    settings = auto_vnc_settings(args)
+    wanted = [k for k in ('quality', 'compression') if settings[k] is not None]
+    if not wanted:
+        return settings
+
+    supported = novnc_settings(port_http, args.ready_timeout)
+    if supported is None:
+        stderr_write("Warning: noVNC is not responding, so the launcher " +
+                     "could not check that it reads the VNC settings.\n")
+        return settings
+    for key in wanted:
+        if key not in supported:
+            stderr_write("Warning: the noVNC of the image does not read " +
+                         key + ", which needs noVNC 1.2 or later, so it " +
+                         "is left out.\n")
+            settings[key] = None
+    return settings
+
+
+def vnc_url(url, settings):
+    """Add the VNC settings to a noVNC URL.
+
+    vnc_settings has checked that noVNC reads quality and compression.
+    """
+
+    params = ''
+    for key in ('quality', 'compression'):
+        if settings[key] is not None:
+            params += '&%s=%d' % (key, settings[key])
+    if not params:
+        return url
+    url = url.rstrip('\n')
+    return (url + params if '?' in url else url + '?' + params[1:]) + '\n'
+
+
+class VNCProbe(object):
+    """Minimal RFB client that counts the bytes of framebuffer updates.
+
+    It asks for Tight encoding with the quality and compression of the
+    settings, as noVNC does, and skips over the encoded data without
+    decoding it. It only connects to servers without a password.
+    """
+
+    def __init__(self, port, settings, timeout=30):
+        self.sock = socket.create_connection(('127.0.0.1', int(port)),
+                                             timeout)
+        self.received = 0
+        self._handshake(settings)
+        # Count the updates only
+        self.received = 0
+
+    def _read(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise EOFError('The VNC server closed the connection.')
+            data += chunk
+        self.received += n
+        return data
+
+    def _u8(self):
+        return struct.unpack('>B', self._read(1))[0]
+
+    def _compact(self):
+        "Read a compact length of Tight encoding"
+        length = 0
+        for i in range(3):
+            byte = self._u8()
+            length |= (byte & 0x7F) << (7 * i)
+            if not byte & 0x80:
+                break
+        return length
+
+    def _handshake(self, settings):
+        version = self._read(12)
+        minor = min(int(version[8:11]), 8)
+        self.sock.sendall(('RFB 003.%03d\n' % minor).encode('ascii'))
+
+        if minor >= 7:
+            types = bytearray(self._read(self._u8()))
+            if not types:
+                reason = struct.unpack('>I', self._read(4))[0]
+                raise IOError(self._read(reason).decode('utf-8', 'replace'))
+            if 1 not in types:
+                raise IOError('The VNC server asks for a password.')
+            self.sock.sendall(b'\1')
+        elif struct.unpack('>I', self._read(4))[0] != 1:
+            raise IOError('The VNC server asks for a password.')
+        if minor >= 8 and struct.unpack('>I', self._read(4))[0]:
+            raise IOError('The VNC server refused the connection.')
+
+        self.sock.sendall(b'\1')
+        self.width, self.height = struct.unpack('>HH', self._read(4))
+        self._read(16)
+        self._read(struct.unpack('>I', self._read(4))[0])
+
+        # 32-bit true color, which Tight sends as 3 bytes per pixel
+        pixel = struct.pack('>BBBBHHHBBB3x', 32, 24, 0, 1, 255, 255, 255,
+                            16, 8, 0)
+        self.sock.sendall(b'\0\0\0\0' + pixel)
+
+        encodings = [7, 1, 0]
+        if settings.get('quality') is not None:
+            encodings.append(-32 + settings['quality'])
+        if settings.get('compression') is not None:
+            encodings.append(-256 + settings['compression'])
+        self.sock.sendall(struct.pack('>BxH%di' % len(encodings), 2,
+                                      len(encodings), *encodings))
+
+    def _skip_tight(self, width, height):
+        ctl = self._u8()
+        kind = ctl >> 4
+        if kind == 8:
+            self._read(3)
+            return
+        if kind == 9:
+            self._read(self._compact())
+            return
+        if kind > 9:
+            raise IOError('Invalid Tight rectangle.')
+
+        rowbytes = width * 3
+        if kind & 4 and self._u8() == 1:
+            colors = self._u8() + 1
+            self._read(colors * 3)
+            rowbytes = (width + 7) // 8 if colors == 2 else width
+        size = rowbytes * height
+        self._read(size if size < 12 else self._compact())
+
+    def update(self, incremental=False):
+        "Request an update of the whole screen and read it"
+
+        self.sock.sendall(struct.pack('>BBHHHH', 3, int(incremental), 0, 0,
+                                      self.width, self.height))
+        while True:
+            kind = self._u8()
+            if kind == 0:
+                break
+            elif kind == 1:
+                self._read(3)
+                self._read(6 * struct.unpack('>H', self._read(2))[0])
+            elif kind == 3:
+                self._read(3)
+                self._read(struct.unpack('>I', self._read(4))[0])
+            elif kind != 2:
+                raise IOError('Unexpected VNC message %d.' % kind)
+
+        self._read(1)
+        for _ in range(struct.unpack('>H', self._read(2))[0]):
+            _, _, width, height, encoding = struct.unpack('>HHHHi',
+                                                          self._read(12))
+            if encoding == 0:
+                self._read(width * height * 4)
+            elif encoding == 1:
+                self._read(4)
+            elif encoding == 7:
+                self._skip_tight(width, height)
+            else:
+                raise IOError('Unexpected VNC encoding %d.' % encoding)
+
+    def close(self):
+        self.sock.close()
+
+
+def vnc_probe(settings, seconds):
+    """Time full-screen VNC updates of the desktop and print them as JSON.
+
+    It runs in the container as the desktop user, and starts another
+    x11vnc on the display for a single client. That server takes no
+    password, since the probe does not have the one of the session, and
+    listens on localhost of the container only, which nothing else
+    reaches. The probe asks for the whole screen again as soon as it has
+    the last frame, for about the given seconds.
+    """
+    import json
+
+    result, server = {}, None
+    try:
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        with open(os.devnull, 'w') as devnull:
+            server = subprocess.Popen(['x11vnc', '-display', ':0',
+                                       '-localhost', '-rfbport', str(port),
+                                       '-nopw', '-once', '-quiet'],
+                                      stdout=devnull, stderr=devnull)
+        start = time.time()
+        while True:
+            try:
+                probe = VNCProbe(port, settings)
+                break
+            except socket.error:
+                if server.poll() is not None or time.time() - start > 10:
+                    raise
+                time.sleep(0.1)
+
+        try:
+            frames, start = 0, time.time()
+            while not frames or time.time() - start < seconds:
+                probe.update()
+                frames += 1
+            result = {'width': probe.width, 'height': probe.height,
+                      'frames': frames, 'bytes': probe.received,
+                      'seconds': time.time() - start}
+        finally:
+            probe.close()
+    except (EOFError, IOError, OSError, socket.error, struct.error) as e:
+        result = {'error': str(e) or e.__class__.__name__}
+    if server and server.poll() is None:
+        server.terminate()
+    sys.stdout.write(json.dumps(result) + '\n')
+    sys.stdout.flush()
+
+
+def report_vnc(docker, container, settings, seconds):
+    """Print the frame rate of full-screen VNC updates of a session.
+
+    vnc_probe measures in the container for about the given seconds, with
+    the settings of the session, how fast x11vnc encodes the whole screen
+    and how many bytes a frame takes. Each frame takes a round trip and
+    its bytes over the link to the browser, which gives the frame rate
+    that reaches the browser. To try a slow link locally, add a delay to
+    the loopback interface, such as with
+    tc qdisc add dev lo root netem delay 50ms rate 8mbit,
+    and start the launcher in ssh localhost.
+    """
+    import inspect
+    import json
+
+    program = '\n\n'.join(
+        ['import json\nimport os\nimport socket\nimport struct\n'
+         'import subprocess\nimport sys\nimport time'] +
+        [inspect.getsource(obj) for obj in (VNCProbe, vnc_probe)] +
+        ['vnc_probe(json.loads(sys.argv[1]), float(sys.argv[2]))\n'])
+    try:
+        pipe = docker.exec_pipe(container, [
+            'env', 'DISPLAY=:0', 'HOME=' + docker_home, 'python3', '-c',
+            program, json.dumps(settings), str(seconds)], user=docker_user)
+        try:
+            line = pipe.readline()
+        finally:
+            pipe.close()
+        result = json.loads(line) if line else {'error': 'no output'}
+    except (OSError, ValueError, socket.error,
+            subprocess.CalledProcessError) as e:
+        result = {'error': str(e)}
+    if 'error' in result:
+        stderr_write('VNC report failed: ' + result['error'] + '\n')
+        return
+
+    def level(value):
+        return 'default' if value is None else value
+
+    fps = result['frames'] / max(result['seconds'], 1e-6)
+    size = result['bytes'] / float(result['frames'])
+    stdout_write('VNC at %dx%d in the container: %.1f full-screen frames/s, '
+                 '%s per frame (Tight, quality %s, compression %s).\n' %
+                 (result['width'], result['height'], fps, format_size(size),
+                  level(settings['quality']), level(settings['compression'])))
+
+    link = measure_client_link()
+    if link is None or link[1] is None:
+        stdout_write(describe_link(link) + '\n')
+    else:
+        fps = min(fps, 1 / (link[0] + size / link[1]))
+        stdout_write(describe_link(link) + ' About %.1f frames/s reach '
+                     'the browser.\n' % fps)
+
+
+def run_container(docker, spec):
+    """Start the container of a spec and return the exit status of docker run.
+
+    Docker passes its environment only to the container command, which
+    starts the desktop or Jupyter and their terminals and kernels. ssh
+    sessions start from a clean environment, so profile_env of the spec
+    is also written to /etc/profile.d for login shells.
+    """
+
+    err = docker.run(spec)
+    if not err and spec['profile_env']:
+        script = ''.join("export %s='%s'\n" % tuple(env.split('=', 1))
+                         for env in spec['profile_env'])
+        docker.exec_detached(spec['name'], [
+            'sh', '-c', 'printf %s "$0" > /etc/profile.d/' + proj + '.sh',
+            script])
+    return err
+
+
+def log_pipe(path, max_size):
+    """Return a shell command that copies its input to stdout and to a log.
+
+    rotatelog of the image caps the log at max_size and compresses old
+    segments. Images without it fall back to appending with tee.
+    """
+
+    rotate = docker_home + '/.local/bin/rotatelog'
+    return 'if [ -x %s ]; then %s --max-size %s %s; else tee -a %s; fi' % \
+        (rotate, rotate, max_size, path, path)
+
+
+def cache_volume(docker, args):
+    """Return the name of the ~/.cache volume of the image, or None.
+
+    The sessions of an image share the volume, and a new image gets a new
+    one, since its packages would not use the old caches. --clear-cache
+    removes the volume first, and --cache-size 0 means no volume.
+    """
+
+    if args.cache_size.strip() == '0':
+        return None
+
+    name = proj + '_cache_' + docker.image_id(args.image).split(':')[-1][:12]
+    if args.clear_cache:
+        try:
+            if args.verbose:
+                stdout_write("Removing cache volume " + name + ".\n")
+            docker.remove_volume(name)
+        except subprocess.CalledProcessError as e:
+            stderr_write((e.output or b'').decode('utf-8'))
+    return name
+
+
+def cache_command(args):
+    """Return a shell command that looks after the cache volume.
+
+    warmcache of the image runs in the background. It removes the least
+    recently used files beyond --cache-size, and warms up a new volume with
+    the font cache of matplotlib and the completions of Jedi for the
+    scientific packages. Images without it use the volume as it is.
+    """
+
+    if not args.cache:
+        return ''
+    warm = docker_home + '/.local/bin/warmcache'
+    return 'if [ -x %s ]; then nice %s --max-size %s --warm %s/.cache ' \
+        '>/dev/null 2>&1 & fi; ' % (warm, warm, args.cache_size, docker_home)
+
+
+class LogBuffer(object):
+    """The latest lines of a container log, and which of them to show.
+
+    Only the last size lines are kept in memory. Jupyter starts its lines
+    with a level, as in "[W 10:00:00.000 NotebookApp]". Other lines, such
+    as tracebacks, have the level of the line before them.
+    """
+
+    levels = 'DIWEC'
+
+    def __init__(self, size=1000, level='info'):
+        import collections
+
+        self.lines = collections.deque(maxlen=size)
+        self.min_level = self.levels.index(level[0].upper())
+        self.level = self.levels.index('I')
+
+    def add(self, line):
+        "Keep a line and return whether it is at or above the level to show"
+        self.lines.append(line)
+        if line[:1] == '[' and line[1:2] in self.levels and line[2:3] == ' ':
+            self.level = self.levels.index(line[1])
+        return self.level >= self.min_level
+
+    def tail(self):
+        "Return the kept lines"
+        return ''.join(self.lines)
+
+
+def agent_path(root, rel):
+    "Join a relative path from a peer to the root, refusing to leave the root"
+
+    parts = rel.split('/')
+    if rel.startswith('/') or '' in parts or '.' in parts or '..' in parts:
+        raise ValueError('Invalid path ' + rel)
+    return os.path.join(root, *parts)
+
+
+class ChangeWatcher(object):
+    """Paths under a directory that may have changed since the last look.
+
+    Uses inotify where it is available, which is Linux and so always in the
+    container. Elsewhere, or when inotify runs out of watches, every look
+    asks for a full scan.
+    """
+
+    # IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO,
+    # IN_CREATE and IN_DELETE
+    mask = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+
+    def __init__(self, root):
+        self.root = root
+        self.fd = None
+        self.dirs = {}
+        self.dirty = set()
+        self.overflow = False
+        try:
+            import ctypes
+            import ctypes.util
+
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                    use_errno=True)
+            fd = self.libc.inotify_init()
+            if fd >= 0:
+                self.fd = fd
+        except (OSError, AttributeError, TypeError):
+            pass
+
+    def watch(self, rel):
+        "Watch a directory, given relative to the root"
+
+        if self.fd is None:
+            return
+        path = os.path.join(self.root, rel)
+        if not isinstance(path, bytes):
+            path = path.encode(sys.getfilesystemencoding())
+        wd = self.libc.inotify_add_watch(self.fd, path, self.mask)
+        if wd >= 0:
+            self.dirs[wd] = rel
+        else:
+            # Usually out of watches, so fall back to scanning everything
+            os.close(self.fd)
+            self.fd = None
+
+    def _read(self):
+        import struct
+
+        data = os.read(self.fd, 65536)
+        pos = 0
+        while pos + 16 <= len(data):
+            wd, mask, _, size = struct.unpack('iIII', data[pos:pos + 16])
+            name = data[pos + 16:pos + 16 + size].rstrip(b'\0')
+            pos += 16 + size
+            if mask & 0x4000:
+                # IN_Q_OVERFLOW
+                self.overflow = True
+            elif mask & 0x8000:
+                # IN_IGNORED, after a directory is removed
+                self.dirs.pop(wd, None)
+            elif wd in self.dirs and name:
+                if not isinstance(name, str):
+                    name = name.decode(sys.getfilesystemencoding())
+                rel = self.dirs[wd]
+                self.dirty.add(rel + '/' + name if rel else name)
+
+    def _drain(self):
+        import select
+
+        while self.fd is not None and select.select([self.fd], [], [], 0)[0]:
+            self._read()
+
+    def wait(self, timeout):
+        "Wait up to timeout seconds for a change and tell whether there is one"
+
+        import select
+
+        if self.fd is None:
+            time.sleep(timeout)
+            return True
+
+        if select.select([self.fd], [], [], timeout)[0]:
+            # Let a burst of changes settle into one scan
+            time.sleep(0.05)
+            self._drain()
+        return bool(self.dirty or self.overflow or self.fd is None)
+
+    def take(self):
+        "Return the changed paths and forget them, or None to scan everything"
+
+        if self.fd is not None:
+            self._drain()
+        if self.fd is None or self.overflow:
+            self.dirty, self.overflow = set(), False
+            return None
+        dirty, self.dirty = self.dirty, set()
+        return dirty
+
+
+class SyncAgent(object):
+    """One side of a synchronized directory.
+
+    The agent keeps the size, modification time, executable bit and SHA-1
+    of every regular file, and hashes a file again only when its size or
+    modification time change. Symbolic links and files whose names start
+    with .sync- are not synchronized. The engine uses an agent in the
+    launcher for the host directory, and one in the container through
+    serve_agent.
+    """
+
+    chunk = 1 << 22
+    ops = ('identity', 'scan', 'wait', 'read', 'write', 'remove')
+    private = '.sync-'
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.files = {}
+        self.partial = {}
+        self.scanned = False
+        self.watcher = ChangeWatcher(self.root)
+        self.umask = os.umask(0o22)
+        os.umask(self.umask)
+
+    def call(self, op, **kwargs):
+        "Run an operation of the sync protocol"
+
+        if op not in self.ops:
+            raise ValueError('Unknown operation ' + op)
+        return getattr(self, op)(**kwargs)
+
+    def _path(self, rel):
+        return agent_path(self.root, rel)
+
+    @staticmethod
+    def _mtime(st):
+        return getattr(st, 'st_mtime_ns', None) or int(st.st_mtime * 1e9)
+
+    def _entry(self, rel):
+        "Return the entry of a file, or None if it is not a regular file"
+
+        import hashlib
+        import stat
+
+        try:
+            st = os.lstat(self._path(rel))
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        mtime = self._mtime(st)
+        old = self.files.get(rel)
+        if old and old[0] == st.st_size and old[1] == mtime:
+            return old
+
+        sha = hashlib.sha1()
+        try:
+            with open(self._path(rel), 'rb') as f:
+                for block in iter(lambda: f.read(self.chunk), b''):
+                    sha.update(block)
+        except (IOError, OSError):
+            return None
+        return [st.st_size, mtime, int(bool(st.st_mode & 0o111)),
+                sha.hexdigest()]
+
+    def _update(self, rel, changes):
+        entry = self._entry(rel)
+        if entry != self.files.get(rel):
+            changes[rel] = entry
+            if entry:
+                self.files[rel] = entry
+            else:
+                del self.files[rel]
+
+    def _walk(self, top, changes):
+        "Rescan a directory, given relative to the root, and its subdirectories"
+
+        seen = set()
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.root,
+                                                                 top)):
+            rel = os.path.relpath(dirpath, self.root).replace(os.sep, '/')
+            rel = '' if rel == '.' else rel
+            self.watcher.watch(rel)
+            for name in filenames:
+                if not name.startswith(self.private):
+                    path = rel + '/' + name if rel else name
+                    seen.add(path)
+                    self._update(path, changes)
+
+        prefix = top + '/' if top else ''
+        for path in [p for p in self.files if p.startswith(prefix)]:
+            if path not in seen:
+                changes[path] = None
+                del self.files[path]
+
+    def identity(self):
+        """Return the ID of the directory, which is new if the directory is.
+
+        The ID tells the engine whether its last sync was with this copy.
+        """
+
+        import uuid
+
+        path = os.path.join(self.root, self.private + 'id')
+        if not os.path.exists(path):
+            with open(path, 'w') as f:
+                f.write(uuid.uuid4().hex)
+        with open(path) as f:
+            return {'id': f.read().strip()}
+
+    def scan(self):
+        """Return the files that changed since the last scan.
+
+        Removed files have None as their entry.
+        """
+
+        dirty = self.watcher.take() if self.scanned else None
+        self.scanned = True
+        changes = {}
+        if dirty is None:
+            self._walk('', changes)
+            return {'changes': changes}
+
+        for rel in dirty:
+            if os.path.basename(rel).startswith(self.private):
+                continue
+            path = self._path(rel)
+            if os.path.isdir(path) and not os.path.islink(path):
+                self._walk(rel, changes)
+            elif os.path.lexists(path):
+                self._update(rel, changes)
+            else:
+                # Removed, or moved away with everything under it
+                for p in [p for p in self.files
+                          if p == rel or p.startswith(rel + '/')]:
+                    changes[p] = None
+                    del self.files[p]
+        return {'changes': changes}
+
+    def wait(self, timeout):
+        "Wait up to timeout seconds for changes"
+        return {'changed': self.watcher.wait(timeout)}
+
+    def read(self, path, offset=0):
+        "Return a chunk of a file in base64"
+
+        import base64
+
+        with open(self._path(path), 'rb') as f:
+            f.seek(offset)
+            data = f.read(self.chunk)
+        return {'data': base64.b64encode(data).decode('ascii'),
+                'size': len(data), 'more': len(data) == self.chunk}
+
+    def _digest(self, rel):
+        entry = self._entry(rel)
+        return entry[3] if entry else None
+
+    def write(self, path, data, offset, more, exe, mtime, expect):
+        """Write a chunk of a file, which replaces the file after the last one.
+
+        The write is a conflict if the file is not the one with SHA-1 expect,
+        or None for a new file, since the other side saw it.
+        """
+
+        import base64
+        import hashlib
+
+        target = self._path(path)
+        tmp = os.path.join(os.path.dirname(target),
+                           self.private + 'tmp-' + os.path.basename(target))
+        if offset == 0:
+            if self._digest(path) != expect:
+                return {'conflict': True}
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            open(tmp, 'wb').close()
+            self.partial[path] = hashlib.sha1()
+
+        data = base64.b64decode(data)
+        with open(tmp, 'ab') as f:
+            f.write(data)
+        self.partial[path].update(data)
+        if more:
+            return {}
+
+        sha = self.partial.pop(path)
+        if self._digest(path) != expect:
+            os.remove(tmp)
+            return {'conflict': True}
+        os.chmod(tmp, (0o777 if exe else 0o666) & ~self.umask)
+        os.utime(tmp, (time.time(), mtime / 1e9))
+        if os.name == 'nt' and os.path.exists(target):
+            os.remove(target)
+        os.rename(tmp, target)
+
+        # What the next scan finds, without hashing the file again
+        st = os.lstat(target)
+        self.files[path] = [st.st_size, self._mtime(st), int(bool(exe)),
+                            sha.hexdigest()]
+        return {'entry': self.files[path]}
+
+    def remove(self, path, expect):
+        "Remove a file that has SHA-1 expect, and the directories it leaves empty"
+
+        if self._digest(path) != expect:
+            return {'conflict': True}
+
+        target = self._path(path)
+        os.remove(target)
+        self.files.pop(path, None)
+        parent = os.path.dirname(target)
+        while parent != self.root and not os.listdir(parent):
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
+        return {}
+
+
+def serve_agent(agent):
+    "Answer the requests of a peer on stdin with replies on stdout"
+
+    import json
+
+    for line in iter(sys.stdin.readline, ''):
+        try:
+            reply = agent.call(**json.loads(line))
+        except (IOError, OSError, ValueError) as e:
+            reply = {'error': str(e)}
+        sys.stdout.write(json.dumps(reply) + '\n')
+        sys.stdout.flush()
+
+
+def agent_program(agent, *needs):
+    """Return a Python program that serves an agent class.
+
+    The program takes the directory of the agent as its argument and
+    answers requests on stdin and stdout. It runs wherever a pipe reaches,
+    such as python3 -c in the container, or in a local process for testing.
+    needs are the other classes and functions that the agent uses.
+    """
+    import inspect
+
+    return '\n\n'.join(['import os\nimport sys\nimport time'] +
+                       [inspect.getsource(obj) for obj in
+                        needs + (agent_path, agent, serve_agent)] +
+                       ['serve_agent(%s(sys.argv[1]))\n' % agent.__name__])
+
+
+class AgentPeer(object):
+    """Agent at the other end of a pipe.
+
+    Failed operations raise IOError, and EOFError means that the agent or
+    the container went away.
+    """
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def call(self, op, **kwargs):
+        "Run an operation of the agent"
+
+        import json
+
+        kwargs['op'] = op
+        self.pipe.write(json.dumps(kwargs) + '\n')
+        line = self.pipe.readline()
+        if not line:
+            raise EOFError('The agent has exited.')
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise IOError(reply['error'])
+        return reply
+
+
+class SyncEngine(object):
+    """Two-way sync between a host directory and a directory in a container.
+
+    host and remote are a SyncAgent or an AgentPeer. The engine keeps the
+    SHA-1 of every file as of the last sync, and saves it in the file index
+    so that a later session can tell changes on each side apart. The index
+    only applies to the remote copy it was made with, so a new volume is
+    merged with the host directory and nothing is removed. A file
+    that changed on both sides keeps the newer version, and the other one
+    is copied next to it as NAME.sync-conflict-DATE.EXT on both sides. A
+    file that was changed on one side and removed on the other is kept.
+    """
+
+    def __init__(self, host, remote, index=None):
+        import json
+
+        self.sides = (host, remote)
+        self.files = ({}, {})
+        self.index = index
+        self.base = {}
+        self.remote_id = None
+        try:
+            with open(index) as f:
+                saved = json.load(f)
+            self.remote_id, self.base = saved['remote'], saved['base']
+        except (TypeError, IOError, ValueError, KeyError):
+            # No index yet, or an unreadable one, so merge as for a new volume
+            pass
+        self.stats = {'files': 0, 'bytes': 0, 'conflicts': 0}
+        self.first = True
+        self.stopping = threading.Event()
+        self.thread = None
+        self.error = None
+
+    def save(self):
+        import json
+
+        if self.index:
+            with open(self.index + '.tmp', 'w') as f:
+                json.dump({'remote': self.remote_id, 'base': self.base}, f)
+            if os.name == 'nt' and os.path.exists(self.index):
+                os.remove(self.index)
+            os.rename(self.index + '.tmp', self.index)
+
+    def transfer(self, src, dst, path, dst_path=None):
+        """Copy a file, or its removal, from side src to side dst.
+
+        Returns whether dst has changed. It has not if dst changed after
+        its last scan, which the next sync will see.
+        """
+
+        dst_path = dst_path or path
+        entry = self.files[src].get(path)
+        old = self.files[dst].get(dst_path)
+        expect = old[3] if old else None
+
+        if entry is None:
+            if self.sides[dst].call('remove', path=dst_path,
+                                    expect=expect).get('conflict'):
+                return False
+            self.files[dst].pop(dst_path, None)
+            self.base.pop(dst_path, None)
+            self.stats['files'] += 1
+            return True
+
+        offset = 0
+        while True:
+            chunk = self.sides[src].call('read', path=path, offset=offset)
+            reply = self.sides[dst].call('write', path=dst_path,
+                                         data=chunk['data'], offset=offset,
+                                         more=chunk['more'], exe=entry[2],
+                                         mtime=entry[1], expect=expect)
+            if reply.get('conflict'):
+                return False
+            offset += chunk['size']
+            if not chunk['more']:
+                break
+
+        # If the source changed during the copy, its next scan says so
+        self.files[dst][dst_path] = reply['entry']
+        self.base[dst_path] = reply['entry'][3]
+        self.stats['files'] += 1
+        self.stats['bytes'] += offset
+        return True
+
+    def conflict(self, path):
+        "Keep the newer version of a file and a copy of the other on both sides"
+
+        host, remote = self.files[0][path], self.files[1][path]
+        loser = 0 if host[1] < remote[1] else 1
+
+        stem, ext = os.path.splitext(path)
+        copy = stem + '.sync-conflict-' + time.strftime('%Y%m%d-%H%M%S') + ext
+        self.transfer(loser, loser, path, copy)
+        self.transfer(loser, 1 - loser, path, copy)
+        self.transfer(1 - loser, loser, path)
+        self.stats['conflicts'] += 1
+        stderr_write('Both copies of ' + path + ' changed. Kept the newer one ' +
+                     'and saved the ' + ('host', 'container')[loser] +
+                     ' copy as ' + copy + '.\n')
+
+    def sync_path(self, path):
+        "Bring the two copies of a file together and return whether one changed"
+
+        host, remote = self.files[0].get(path), self.files[1].get(path)
+        digests = (host[3] if host else None, remote[3] if remote else None)
+        base = self.base.get(path)
+
+        if digests[0] == digests[1]:
+            if digests[0]:
+                self.base[path] = digests[0]
+            else:
+                self.base.pop(path, None)
+            return False
+        if digests[0] == base:
+            return self.transfer(1, 0, path)
+        if digests[1] == base:
+            return self.transfer(0, 1, path)
+        if not host or not remote:
+            # Changed on one side and removed on the other
+            return self.transfer(0 if host else 1, 1 if host else 0, path)
+        self.conflict(path)
+        return True
+
+    def sync(self):
+        "Synchronize the changes since the last sync and return how many files changed"
+
+        paths = set()
+        if self.first:
+            remote_id = self.sides[1].call('identity')['id']
+            if remote_id != self.remote_id:
+                self.remote_id, self.base = remote_id, {}
+            paths.update(self.base)
+            self.first = False
+        for side, files in zip(self.sides, self.files):
+            changes = side.call('scan')['changes']
+            for path, entry in changes.items():
+                if entry:
+                    files[path] = entry
+                else:
+                    files.pop(path, None)
+            paths.update(changes)
+
+        changed = 0
+        for path in sorted(paths):
+            try:
+                changed += self.sync_path(path)
+            except (IOError, OSError) as e:
+                # Usually a file that went away, which the next scan shows
+                stderr_write('Could not synchronize ' + path + ': ' +
+                             str(e) + '\n')
+        if paths:
+            self.save()
+        return changed
+
+    def run(self, interval):
+        "Sync whenever either side changes, until stop is called"
+
+        try:
+            while not self.stopping.is_set():
+                changed = False
+                for side in self.sides:
+                    changed = side.call('wait', timeout=interval / 2.0)['changed'] \
+                        or changed
+                if changed and not self.stopping.is_set():
+                    self.sync()
+        except (EOFError, IOError, OSError, ValueError) as e:
+            self.error = e
+
+    def start(self, interval=1.0):
+        "Keep syncing in a background thread"
+
+        self.thread = threading.Thread(target=self.run, args=(interval,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        "Stop syncing in the background and sync the last changes"
+
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+        if self.error is None:
+            try:
+                self.sync()
+            except (EOFError, IOError, OSError, ValueError) as e:
+                self.error = e
+        if self.error is not None:
+            stderr_write('Synchronization stopped: ' + str(self.error) + '\n')
+
+
+def sync_volume(path):
+    "Return the name of the volume that --sync keeps in sync with a directory"
+    import hashlib
+
+    return proj + '_sync_' + hashlib.sha1(
+        os.path.abspath(path).encode('utf-8')).hexdigest()[:12]
+
+
+def start_sync(docker, container, interval=1.0):
+    """Synchronize the working directory with ~/shared in the container.
+
+    Runs a full sync first and then keeps syncing in the background until
+    the launcher exits. Only one launcher syncs a directory at a time.
+    Returns the engine, or None if another launcher syncs it or the first
+    sync failed.
+    """
+    import atexit
+
+    pwd = os.getcwd()
+    shared = docker_home + '/shared'
+    index = state_path('sync', sync_volume(pwd) + '.json')
+
+    # Two engines on one index would race in their three-way merges, such
+    # as when a launch reattaches to a session that another one syncs
+    lock = FileLock(index + '.lock')
+    if not lock.acquire(blocking=False):
+        stderr_write('Another launcher is synchronizing ' + pwd + ' with ' +
+                     shared + ', so this one does not.\n')
+        return None
+
+    docker.exec_output(container, ['chown', docker_user + ':', shared])
+    program = agent_program(SyncAgent, ChangeWatcher)
+    pipe = docker.exec_pipe(container, ['python3', '-c', program, shared],
+                            user=docker_user)
+    engine = SyncEngine(SyncAgent(pwd), AgentPeer(pipe), index)
+
+    start = time.time()
+    try:
+        engine.sync()
+    except (EOFError, IOError, OSError, ValueError) as e:
+        stderr_write('Could not synchronize ' + pwd + ' with ' + shared +
+                     ': ' + str(e) + '\n')
+        lock.release()
+        return None
+    stdout_write('Synchronized %d files (%s) with %s in %.1f seconds.\n' %
+                 (engine.stats['files'], format_size(engine.stats['bytes']),
+                  shared, time.time() - start))
+
+    engine.start(interval)
+    # atexit runs the last registration first, so the engine stops before
+    # the lock is released
+    atexit.register(lock.release)
+    atexit.register(engine.stop)
+    return engine
+
+
+class VolumeAgent(object):
+    """Files of a volume, read for snapshots and written for restores.
+
+    Regular files are split into chunks of a fixed size that are named by
+    their SHA-256. Directories, symbolic links and the owner, mode and
+    modification time of every entry are kept as well. A pool of threads
+    hashes, compresses and decompresses chunks, since hashlib and zlib
+    release the GIL.
+    """
+
+    chunk = 1 << 20
+    ops = ('scan', 'read', 'put', 'remove', 'finish')
+
+    def __init__(self, root):
+        import multiprocessing.pool
+
+        self.root = os.path.abspath(root)
+        self.threads = max(multiprocessing.cpu_count(), 2)
+        self.pool = multiprocessing.pool.ThreadPool(self.threads)
+
+    def call(self, op, **kwargs):
+        "Run an operation of the volume protocol"
+
+        if op not in self.ops:
+            raise ValueError('Unknown operation ' + op)
+        return getattr(self, op)(**kwargs)
+
+    def _hash(self, rel):
+        import hashlib
+
+        chunks = []
+        try:
+            with open(agent_path(self.root, rel), 'rb') as f:
+                for block in iter(lambda: f.read(self.chunk), b''):
+                    chunks.append(hashlib.sha256(block).hexdigest())
+        except (IOError, OSError):
+            return None
+        return chunks
+
+    def _entry(self, path):
+        import stat
+
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None
+        entry = {'mode': stat.S_IMODE(st.st_mode), 'uid': st.st_uid,
+                 'gid': st.st_gid, 'mtime': st.st_mtime_ns}
+        if stat.S_ISDIR(st.st_mode):
+            entry['type'] = 'd'
+        elif stat.S_ISLNK(st.st_mode):
+            entry['type'] = 'l'
+            entry['target'] = os.readlink(path)
+        elif stat.S_ISREG(st.st_mode):
+            entry['type'] = 'f'
+            entry['size'] = st.st_size
+        else:
+            return None
+        return entry
+
+    def scan(self, known):
+        """Return the entries of the volume.
+
+        Files whose size and modification time match their entry in known
+        keep its chunks and are not read again.
+        """
+
+        entries = {}
+        todo = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                rel = os.path.relpath(path, self.root).replace(os.sep, '/')
+                entry = self._entry(path)
+                if not entry:
+                    continue
+                entries[rel] = entry
+                if entry['type'] == 'f':
+                    old = known.get(rel)
+                    if old and old.get('size') == entry['size'] and \
+                            old.get('mtime') == entry['mtime']:
+                        entry['chunks'] = old['chunks']
+                    else:
+                        todo.append(rel)
+
+        hashed = 0
+        for rel, chunks in zip(todo, self.pool.map(self._hash, todo)):
+            if chunks is None:
+                # Removed while scanning
+                del entries[rel]
+            else:
+                entries[rel]['chunks'] = chunks
+                hashed += entries[rel]['size']
+        return {'entries': entries, 'hashed': hashed, 'threads': self.threads}
+
+    def _read(self, ref):
+        import base64
+        import hashlib
+        import zlib
+
+        try:
+            with open(agent_path(self.root, ref[0]), 'rb') as f:
+                f.seek(ref[1] * self.chunk)
+                data = f.read(self.chunk)
+        except (IOError, OSError):
+            return [None, None, 0]
+        return [hashlib.sha256(data).hexdigest(),
+                base64.b64encode(zlib.compress(data, 6)).decode('ascii'),
+                len(data)]
+
+    def read(self, refs):
+        """Return chunks, given by path and index, compressed with zlib.
+
+        Each chunk comes with the SHA-256 and size of what was read, which
+        differ from the scan if the file changed since, and a chunk of a
+        file that went away has no digest.
+        """
+        return {'chunks': self.pool.map(self._read, refs)}
+
+    @staticmethod
+    def _decode(blob):
+        import base64
+        import hashlib
+        import zlib
+
+        data = zlib.decompress(base64.b64decode(blob[1]))
+        if hashlib.sha256(data).hexdigest() != blob[0]:
+            raise ValueError('Corrupt chunk ' + blob[0])
+        return data
+
+    def _clear(self, target):
+        import shutil
+
+        if os.path.isdir(target) and not os.path.islink(target):
+            shutil.rmtree(target)
+        elif os.path.lexists(target):
+            os.remove(target)
+
+    def _meta(self, path, entry):
+        link = entry['type'] == 'l'
+        os.lchown(path, entry['uid'], entry['gid'])
+        if not link:
+            os.chmod(path, entry['mode'])
+        os.utime(path, ns=(entry['mtime'], entry['mtime']),
+                 follow_symlinks=not link)
+
+    def put(self, path, entry, blobs=(), first=True, last=True):
+        """Restore an entry.
+
+        A file is written from its chunks, given as SHA-256 and compressed
+        data, over one or more calls from first to last, and replaces the
+        old file only once it is complete.
+        """
+
+        target = agent_path(self.root, path)
+        parent = os.path.dirname(target)
+        if first and not os.path.isdir(parent):
+            self._clear(parent)
+            os.makedirs(parent)
+
+        if entry['type'] == 'd':
+            if not os.path.isdir(target) or os.path.islink(target):
+                self._clear(target)
+                os.mkdir(target)
+            self._meta(target, entry)
+        elif entry['type'] == 'l':
+            self._clear(target)
+            os.symlink(entry['target'], target)
+            self._meta(target, entry)
+        else:
+            tmp = os.path.join(parent, '.restore-' + os.path.basename(target))
+            with open(tmp, 'wb' if first else 'ab') as f:
+                for data in self.pool.map(self._decode, blobs):
+                    f.write(data)
+            if last:
+                self._meta(tmp, entry)
+                if os.path.isdir(target) and not os.path.islink(target):
+                    self._clear(target)
+                os.rename(tmp, target)
+        return {}
+
+    def remove(self, paths):
+        "Remove files, symbolic links and directories with their contents"
+
+        for path in paths:
+            self._clear(agent_path(self.root, path))
+        return {}
+
+    def finish(self, dirs):
+        "Set the metadata of directories, once their contents are restored"
+
+        for path in sorted(dirs, reverse=True):
+            self._meta(agent_path(self.root, path), dirs[path])
+        return {}
+
+
+class ChunkStore(object):
+    """Content-addressed store of the chunks of snapshots.
+
+    Each chunk is a file named by the SHA-256 of its content and holds the
+    content compressed with zlib, as it comes from a VolumeAgent. The
+    chunks are shared by all the snapshots of all volumes.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.dirname(state_path('snapshots', 'chunks',
+                                                       'x'))
+
+    def _file(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def has(self, digest):
+        return os.path.exists(self._file(digest))
+
+    def get(self, digest):
+        "Return the compressed content of a chunk"
+        with open(self._file(digest), 'rb') as f:
+            return f.read()
+
+    def put(self, digest, blob):
+        "Add a compressed chunk unless it is already in the store"
+
+        path = self._file(digest)
+        if os.path.exists(path):
+            return
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(blob)
+        os.rename(tmp, path)
+
+    def collect(self, used):
+        "Remove the chunks that are not in used and return their count and size"
+
+        count = size = 0
+        for dirpath, _, filenames in os.walk(self.path):
+            for name in filenames:
+                if name not in used:
+                    path = os.path.join(dirpath, name)
+                    size += os.path.getsize(path)
+                    os.remove(path)
+                    count += 1
+        return count, size
+
+
+def snapshot_names(volume):
+    "Return the names of the snapshots of a volume, from the oldest"
+
+    path = os.path.dirname(state_path('snapshots', volume, 'x'))
+    return sorted(name[:-5] for name in os.listdir(path)
+                  if name.endswith('.json'))
+
+
+def load_snapshot(volume, name):
+    "Return the manifest of a snapshot"
+    import json
+
+    with open(state_path('snapshots', volume, name + '.json')) as f:
+        return json.load(f)
+
+
+def prune_snapshots(volume, keep):
+    """Remove all but the newest keep snapshots of a volume.
+
+    Chunks that no snapshot of any volume uses any more are removed from
+    the store. Returns the number of snapshots and chunks removed and the
+    size of the chunks.
+    """
+
+    names = snapshot_names(volume)
+    old = names[:-keep] if keep > 0 else []
+    for name in old:
+        os.remove(state_path('snapshots', volume, name + '.json'))
+
+    store = ChunkStore()
+    used = set()
+    top = os.path.dirname(store.path)
+    for vol in os.listdir(top):
+        if vol != os.path.basename(store.path) and \
+                os.path.isdir(os.path.join(top, vol)):
+            for name in snapshot_names(vol):
+                for entry in load_snapshot(vol, name)['entries'].values():
+                    used.update(entry.get('chunks', ()))
+    return (len(old),) + store.collect(used)
+
+
+def volume_container(docker, args, volume, reuse=True):
+    """Return a container with a volume for a VolumeAgent.
+
+    With reuse, a running session that mounts the volume is used if there
+    is one. Otherwise, a helper container is started, which the caller
+    removes. Returns the container, the path of the volume in it and
+    whether the container is a helper, or None if the helper failed.
+    """
+
+    if reuse:
+        for info in docker.containers(label_ns + 'volume=' + volume):
+            if not info['State']['Paused']:
+                return (info['Name'].lstrip('/'),
+                        docker_home + '/' + projdir, False)
+
+    name = start_helper(docker, args, [volume + ':/data'])
+    if not name:
+        return None
+    return name, '/data', True
+
+
+def start_helper(docker, args, binds):
+    """Start a helper container of the image that runs nothing.
+
+    Commands run in it with exec, as root, on the volumes in binds. Returns
+    its name, or None if it did not start.
+    """
+
+    name = proj + '-helper-' + id_generator().split('-')[-1]
+    spec = {'image': args.image,
+            'name': name,
+            'hostname': name,
+            'command': 'sleep infinity',
+            'env': [],
+            'ports': [],
+            'binds': binds,
+            'workdir': '/',
+            'devices': [],
+            'shm_size': '64m',
+            'cpus': None,
+            'memory': None,
+            'cpuset': None,
+            'log_opts': None,
+            'remove': True,
+            'security_opt': [],
+            'cap_add': [],
+            'extra_args': [],
+            'labels': {label_ns + 'kind': 'helper'},
+            'profile_env': []}
+    if args.verbose:
+        cmd = run_command(spec)
+        stdout_write(' '.join(cmd[:-1]) + ' "' + cmd[-1] + '"\n')
+    if docker.run(spec):
+        return None
+    return name
+
+
+def run_snapshot(docker, args):
+    """Take an incremental snapshot of the project data volume.
+
+    The files of the volume are split into chunks, which are compressed in
+    the container and copied into a content-addressed store in the launcher
+    state directory. Only the chunks that no earlier snapshot has are
+    copied, and only the files that changed since the last snapshot are
+    read again. Use --list to list the snapshots instead.
+    """
+
+    volume = args.volume
+    if args.list:
+        for name in snapshot_names(volume):
+            entries = load_snapshot(volume, name)['entries'].values()
+            stdout_write('%s  %6d entries  %s\n' % (
+                name, len(entries),
+                format_size(sum(e.get('size', 0) for e in entries))))
+        return 0
+
+    # Pruning must not remove the chunks of a snapshot in progress
+    with FileLock(state_path('snapshots', 'lock')):
+        status = take_snapshot(docker, args, volume)
+        if status or not args.keep:
+            return status
+
+        removed, count, size = prune_snapshots(volume, args.keep)
+    if removed:
+        stdout_write('Removed %d old snapshots and %d chunks (%s).\n' %
+                     (removed, count, format_size(size)))
+    return 0
+
+
+def take_snapshot(docker, args, volume):
+    "Copy the new chunks of a volume into the store and write its manifest"
+    import base64
+    import json
+
+    names = snapshot_names(volume)
+    previous = load_snapshot(volume, names[-1]) if names else {}
+    if previous.get('chunk') == VolumeAgent.chunk:
+        known = dict((path, entry) for path, entry in
+                     previous['entries'].items() if entry['type'] == 'f')
+    else:
+        known = {}
+
+    found = volume_container(docker, args, volume)
+    if not found:
+        return -1
+    container, root, helper = found
+
+    store = ChunkStore()
+    start = time.time()
+    try:
+        program = agent_program(VolumeAgent)
+        agent = AgentPeer(docker.exec_pipe(container,
+                                           ['python3', '-c', program, root]))
+        scan = agent.call('scan', known=known)
+        entries = scan['entries']
+        scanned = time.time()
+
+        refs = []
+        wanted = set()
+        for path in sorted(entries):
+            for i, digest in enumerate(entries[path].get('chunks', ())):
+                if digest not in wanted and not store.has(digest):
+                    wanted.add(digest)
+                    refs.append((path, i))
+
+        copied = packed = 0
+        batch = 4 * scan['threads']
+        for k in range(0, len(refs), batch):
+            chunks = agent.call('read', refs=refs[k:k + batch])['chunks']
+            for (path, i), (digest, blob, size) in zip(refs[k:k + batch],
+                                                       chunks):
+                if path not in entries:
+                    continue
+                if digest is None:
+                    stderr_write('Skipping ' + path + ', which went away.\n')
+                    del entries[path]
+                    continue
+                # The file changed since the scan, so keep what was read
+                entries[path]['chunks'][i] = digest
+                blob = base64.b64decode(blob)
+                store.put(digest, blob)
+                copied += size
+                packed += len(blob)
+    except (EOFError, IOError, OSError, ValueError) as e:
+        stderr_write('Could not take a snapshot of ' + volume + ': ' +
+                     str(e) + '\n')
+        return -1
+    finally:
+        if helper:
+            docker.remove_container(container)
+
+    name = time.strftime('%Y%m%d-%H%M%S')
+    if name in names:
+        name += '-%d' % len(names)
+    path = state_path('snapshots', volume, name + '.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'volume': volume, 'image': args.image,
+                   'created': time.time(), 'chunk': VolumeAgent.chunk,
+                   'entries': entries}, f)
+    os.rename(path + '.tmp', path)
+
+    elapsed = time.time() - start
+    total = sum(e.get('size', 0) for e in entries.values())
+    stdout_write('Snapshot %s of %s: %d entries, %s.\n' %
+                 (name, volume, len(entries), format_size(total)))
+    stdout_write('Hashed %s in %.1f seconds and copied %d new chunks, '
+                 '%s (%s compressed), in %.1f seconds: %s/s.\n' %
+                 (format_size(scan['hashed']), scanned - start, len(refs),
+                  format_size(copied), format_size(packed),
+                  time.time() - scanned,
+                  format_size(copied / max(time.time() - scanned, 1e-3))))
+    stdout_write('Total %.1f seconds, %s/s of volume data.\n' %
+                 (elapsed, format_size(total / max(elapsed, 1e-3))))
+    return 0
+
+
+def run_restore(docker, args):
+    """Restore the project data volume from a snapshot.
+
+    Restores the newest snapshot of the volume, or the one given. Files
+    that already match the snapshot are kept, only the others are written,
+    and files that are not in the snapshot are removed. The volume must not
+    be in use by a session.
+    """
+
+    volume = args.volume
+    names = snapshot_names(volume)
+    name = args.snapshot or (names[-1] if names else None)
+    if name not in names:
+        stderr_write('No snapshot ' + (name or '') + ' of ' + volume +
+                     '. Use "snapshot --list" to list them.\n')
+        return -1
+
+    if docker.containers(label_ns + 'volume=' + volume):
+        stderr_write('The volume ' + volume + ' is in use. Stop its ' +
+                     'sessions before restoring it.\n')
+        return -1
+
+    found = volume_container(docker, args, volume, reuse=False)
+    if not found:
+        return -1
+    try:
+        with FileLock(state_path('snapshots', 'lock')):
+            return restore_snapshot(docker, found[0], found[1], volume, name)
+    finally:
+        docker.remove_container(found[0])
+
+
+def restore_snapshot(docker, container, root, volume, name):
+    "Make the volume, mounted at root in the container, match a snapshot"
+    import base64
+
+    entries = load_snapshot(volume, name)['entries']
+    store = ChunkStore()
+    start = time.time()
+    written = size = 0
+    try:
+        program = agent_program(VolumeAgent)
+        agent = AgentPeer(docker.exec_pipe(container,
+                                           ['python3', '-c', program, root]))
+        known = dict((path, entry) for path, entry in entries.items()
+                     if entry['type'] == 'f')
+        scan = agent.call('scan', known=known)
+        current = scan['entries']
+
+        # Directories come before their contents, which go with them
+        stale = []
+        for path in sorted(current, key=lambda p: p.split('/')):
+            if stale and path.startswith(stale[-1] + '/'):
+                del current[path]
+            elif path not in entries or \
+                    entries[path]['type'] != current[path]['type']:
+                stale.append(path)
+                del current[path]
+        agent.call('remove', paths=stale)
+
+        batch = 4 * scan['threads']
+        for path in sorted(entries):
+            entry = entries[path]
+            if current.get(path) == entry:
+                continue
+            chunks = entry.get('chunks', [])
+            for k in range(0, max(len(chunks), 1), batch):
+                blobs = [[digest, base64.b64encode(store.get(digest)).decode(
+                    'ascii')] for digest in chunks[k:k + batch]]
+                agent.call('put', path=path, entry=entry, blobs=blobs,
+                           first=k == 0, last=k + batch >= len(chunks))
+            written += 1
+            size += entry.get('size', 0)
+
+        agent.call('finish', dirs=dict((path, entry) for path, entry in
+                                       entries.items()
+                                       if entry['type'] == 'd'))
+    except (EOFError, IOError, OSError, ValueError) as e:
+        stderr_write('Could not restore ' + volume + ': ' + str(e) + '\n')
+        return -1
+
+    elapsed = time.time() - start
+    stdout_write('Restored %s from snapshot %s: wrote %d of %d entries, %s, '
+                 'and removed %d, in %.1f seconds: %s/s.\n' %
+                 (volume, name, written, len(entries), format_size(size),
+                  len(stale), elapsed, format_size(size / max(elapsed, 1e-3))))
+    return 0
+
+
+def golden_volume(image_id):
+    "Return the name of the golden config volume of an image"
+    return proj + '_golden_' + image_id.split(':')[-1][:12]
+
+
+def build_golden(docker, spec, golden):
+    """Fill the golden config volume with the first-run settings of a session.
+
+    Runs the command of the session spec in a helper container that has
+    only the golden volume mounted at ~/.config, so the desktop, Spyder and
+    Jupyter create their settings and caches there as on a first launch,
+    and stops it once the session prints its URL. Returns whether the
+    session got that far.
+    """
+    import copy
+
+    name = proj + '-golden-' + id_generator().split('-')[-1]
+    helper = copy.deepcopy(spec)
+    helper.update({'name': name,
+                   'hostname': name,
+                   'ports': [],
+                   'binds': [golden + ':' + docker_home + '/.config'],
+                   'cpus': None,
+                   'memory': None,
+                   'cpuset': None,
+                   'remove': True,
+                   'extra_args': [],
+                   'labels': {label_ns + 'kind': 'helper'}})
+    if docker.run(helper):
+        return False
+
+    try:
+        p = docker.follow_logs(name)
+        try:
+            ready = any('http://' in line for line in iter(p.readline, ''))
+        finally:
+            p.close()
+        if ready:
+            # Settings written right after startup, such as by the panel
+            time.sleep(2)
+            docker.exec_output(name, ['sync'])
+        return ready
+    finally:
+        docker.remove_container(name)
+
+
+def run_golden(docker, args, spec):
+    """Build the golden config volume of the image.
+
+    New config volumes, including those that --reset starts over, are
+    clones of the golden volume of their image, so the first launch does
+    not have to initialize the settings of the desktop, Spyder and Jupyter.
+    The golden volume is built again each time, since a new image gets one
+    of its own. Returns the exit status.
+    """
+
+    golden = golden_volume(docker.image_id(args.image))
+    if docker.has_volume(golden):
+        docker.remove_volume(golden)
+
+    start = time.time()
+    stdout_write('Building ' + golden + ' for ' + args.image + '.\n')
+    if not build_golden(docker, spec, golden):
+        stderr_write('The session of ' + args.image + ' did not start.\n')
+        docker.remove_volume(golden)
+        return -1
+    stdout_write('Built %s in %.1f seconds.\n' % (golden, time.time() - start))
+    return 0
+
+
+def seed_config(docker, args, config):
+    """Clone the golden config volume of the image into a new config volume.
+
+    Does nothing if the config volume exists or --no-golden is given, and
+    suggests the golden command if the image has no golden volume yet.
+    Returns whether the config volume was cloned.
+    """
+
+    if args.no_golden or docker.has_volume(config):
+        return False
+
+    golden = golden_volume(docker.image_id(args.image))
+    if not docker.has_volume(golden):
+        stdout_write('Run "' + os.path.basename(sys.argv[0]) + ' golden" ' +
+                     'once to start new config volumes ready to use.\n')
+        return False
+
+    if args.verbose:
+        stdout_write('Cloning ' + golden + ' into ' + config + '.\n')
+    helper = start_helper(docker, args, [golden + ':/golden:ro',
+                                         config + ':/config'])
+    if not helper:
+        return False
+    try:
+        docker.exec_output(helper, ['cp', '-a', '/golden/.', '/config/'])
+        cloned = True
+    except subprocess.CalledProcessError as e:
+        stderr_write('Could not clone ' + golden + ': ' +
+                     (e.output or b'').decode('utf-8') + '\n')
+        cloned = False
+    docker.remove_container(helper)
+    if not cloned:
+        # Start from an empty volume rather than a partial copy
+        docker.remove_volume(config)
+    return cloned
+
+
+def session_resources(docker, args, count=1):
+    """Size the resources of count new sessions.
+
+    Values of --cpus, --memory, --shm-size and --cpuset other than auto
+    are used as given, and none, the default, means no limit. With auto,
+    the CPUs and memory of the Docker host are shared by the sessions that
+    are running and the new ones, each session gets a cpuset that overlaps
+    the others as little as possible, and shared memory is half of the
+    memory limit, or 2 GB without a limit as before. The cpuset has as many
+    CPUs as --cpus, or the share of the session without a CPU count.
+    --threads defaults to the number of CPUs of the container. With
+    --mpi-ranks, the container gets a CPU per rank, a thread per rank
+    and CPU, and at least 512 MB of shared memory per rank. Returns a
+    list with a dict of cpus, memory, cpuset, shm_size, threads and
+    log_opts for each session. log_opts caps the log that Docker keeps,
+    if its logging driver supports it.
+    """
+
+    info = docker.host_info()
+    ncpu, memtotal = info['NCPU'], info['MemTotal']
+    log_opts = None
+    if info.get('LoggingDriver') in ('json-file', 'local'):
+        log_opts = {'max-size': args.log_max_size, 'max-file': '3'}
+    running = docker.containers(label_ns + 'session')
+    sessions = len(running) + count
+
+    cpus = memory = None
+    ranks = args.mpi_ranks
+    # The CPUs of each session when the host is shared between them
+    share = max(1, ncpu // sessions)
+    if ranks:
+        share = min(max(share, ranks), ncpu)
+    if args.cpus == 'auto':
+        cpus = share
+    elif args.cpus != 'none':
+        cpus = float(args.cpus)
+
+    if args.memory == 'auto':
+        # Leave some memory to the host
+        memory = int(memtotal * 0.9 / sessions)
+    elif args.memory != 'none':
+        memory = parse_size(args.memory)
+
+    if args.shm_size == 'auto':
+        shm = max(memory // 2 if memory else 2 << 30, ranks << 29)
+        shm_size = '%dm' % max(shm >> 20, 64)
+    else:
+        shm_size = args.shm_size
+
+    load = {}
+    for container in running:
+        for cpu in parse_cpuset(container['HostConfig'].get('CpusetCpus') or ''):
+            load[cpu] = load.get(cpu, 0) + 1
+    nodes = numa_nodes(ncpu) if args.cpuset == 'auto' else None
+
+    resources = []
+    for _ in range(count):
+        cpuset = None
+        if args.cpuset == 'auto':
+            cpuset = choose_cpuset(nodes, int(-(-(cpus or share) // 1)), load)
+            for cpu in cpuset:
+                load[cpu] = load.get(cpu, 0) + 1
+            cpuset = format_cpuset(cpuset)
+        elif args.cpuset != 'none':
+            cpuset = args.cpuset
+
+        threads = None
+        if args.threads == 'auto':
+            if cpuset:
+                threads = len(parse_cpuset(cpuset))
+            else:
+                threads = int(-(-(cpus or ncpu) // 1))
+            if ranks:
+                threads = max(1, threads // ranks)
+        elif args.threads != 'none':
+            threads = int(args.threads)
+
+        resources.append({'cpus': cpus and str(cpus), 'memory': memory,
+                          'cpuset': cpuset, 'shm_size': shm_size,
+                          'threads': threads, 'log_opts': log_opts})
+    return resources
+
+
+class DockerCLI(object):
+    """Docker backend that runs the docker command-line client"""
+
+    name = 'cli'
+
+    def version(self):
+        "Return the Docker version"
+        out = subprocess.check_output(['docker', '--version'])
+        return out.decode('utf-8').split('version')[-1].split(',')[0].strip()
+
+    def host_info(self):
+        "Return the system information of the Docker host, such as NCPU"
+        import json
+
+        return json.loads(subprocess.check_output(
+            ['docker', 'info', '--format', '{{json .}}']).decode('utf-8'))
+
+    def image_id(self, image):
+        "Return the short ID of a local image, or an empty string"
+        out = subprocess.check_output(['docker', 'images', '-q', image])
+        return out.decode('utf-8').split('\n')[0].strip()
+
+    def image_digests(self, image):
+        "Return the registry digests of a local image"
+        import json
+
+        try:
+            out = subprocess.check_output(['docker', 'image', 'inspect', '-f',
+                                           '{{json .RepoDigests}}', image],
+                                          stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError:
+            return []
+        return [d.split('@')[-1] for d in json.loads(out.decode('utf-8')) or []]
+
+    def dangling_images(self):
+        "Return the short IDs of dangling images"
+        return subprocess.check_output(['docker', 'images', '-f',
+                                        'dangling=true', '-q']).decode('utf-8').split()
+
+    def pull(self, image):
+        "Pull an image and return the exit status"
+        return subprocess.call(["docker", "pull", image])
+
+    def remove_image(self, img):
+        "Remove an image in the background"
+        subprocess.Popen(["docker", "rmi", "-f", img])
+
+    def images(self, repo):
+        "Return the inspected tagged images of a repository"
+        import json
+
+        ids = subprocess.check_output(['docker', 'images', '-q', '--no-trunc',
+                                       repo]).decode('utf-8').split()
+        if not ids:
+            return []
+        return json.loads(subprocess.check_output(
+            ['docker', 'image', 'inspect'] + sorted(set(ids))).decode('utf-8'))
+
+    def remove_tag(self, ref):
+        "Remove a tag, and its image if no other tag or container uses it"
+        subprocess.check_output(["docker", "rmi", ref], stderr=subprocess.STDOUT)
+
+    def remove_volume(self, name):
+        "Remove a volume"
+        subprocess.check_output(["docker", "volume", "rm", "-f", name])
+
+    def has_volume(self, name):
+        "Check whether a volume exists"
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call(["docker", "volume", "inspect", name],
+                                   stdout=devnull, stderr=devnull) == 0
+
+    def run(self, spec):
+        "Start a container and return the exit status of docker run"
+        return subprocess.call(run_command(spec))
+
+    def exec_output(self, container, cmd):
+        "Run a command in a container and return its output"
+        return subprocess.check_output(["docker", "exec", container] + cmd)
+
+    def exec_detached(self, container, cmd):
+        "Start a command in a container without waiting for it"
+        subprocess.Popen(["docker", "exec", container] + cmd,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def exec_stream(self, container, cmd):
+        "Run a command in a container and return a line reader of its output"
+        return ProcessStream(subprocess.Popen(["docker", "exec", container] + cmd,
+                                              stdout=subprocess.PIPE,
+                                              stderr=subprocess.PIPE,
+                                              universal_newlines=True))
+
+    def exec_pipe(self, container, cmd, user=''):
+        "Run a command in a container and return a pipe to its stdin and stdout"
+        user = ["-u", user] if user else []
+        return ProcessStream(subprocess.Popen(["docker", "exec", "-i"] + user +
+                                              [container] + cmd,
+                                              stdin=subprocess.PIPE,
+                                              stdout=subprocess.PIPE,
+                                              universal_newlines=True))
+
+    def follow_logs(self, container, since=None):
+        """Return a line reader that follows the stdout of a container.
+
+        Output before the Unix time since is skipped.
+        """
+        return self.logs(container, follow=True, since=since)
+
+    def logs(self, container, follow=False, since=None):
+        "Return a line reader for the stdout of a container"
+        devnull = open(os.devnull, 'w')
+        since = ["--since", str(since)] if since else []
+        follow = ["-f"] if follow else []
+        return ProcessStream(subprocess.Popen(["docker", "logs"] + follow +
+                                              since + [container],
+                                              stdout=subprocess.PIPE,
+                                              stderr=devnull,
+                                              universal_newlines=True))
+
+    def wait(self, container):
+        "Block until the container stops"
+        subprocess.check_output(["docker", "exec", container,
+                                 "tail", "-f", "/dev/null"])
+
+    def is_running(self, container):
+        "Check whether a container is running"
+        return bool(subprocess.check_output(['docker', 'ps', '-q', '-f',
+                                             'name=' + container]))
+
+    def inspect(self, container):
+        "Return the low-level information on a container"
+        import json
+
+        return json.loads(subprocess.check_output(
+            ['docker', 'inspect', container]).decode('utf-8'))[0]
+
+    def containers(self, label=None):
+        "Return the inspected running containers, with the given label if any"
+        import json
+
+        label = ['-f', 'label=' + label] if label else []
+        ids = subprocess.check_output(['docker', 'ps', '-q'] +
+                                      label).decode('utf-8').split()
+        if not ids:
+            return []
+        return json.loads(subprocess.check_output(['docker', 'inspect'] +
+                                                  ids).decode('utf-8'))
+
+    def rename(self, container, name):
+        "Rename a container"
+        subprocess.check_output(['docker', 'rename', container, name],
+                                stderr=subprocess.STDOUT)
+
+    def pause(self, container):
+        "Pause all processes in a container"
+        subprocess.check_output(['docker', 'pause', container])
+
+    def unpause(self, container):
+        "Resume a paused container"
+        subprocess.check_output(['docker', 'unpause', container])
+
+    def remove_container(self, container):
+        "Stop and remove a container, even if it is paused"
+        subprocess.check_output(['docker', 'rm', '-f', container])
+
+
+class DockerAPI(object):
+    """Docker backend that talks to the Docker Engine API.
+
+    Short requests share one keep-alive connection to the daemon at
+    DOCKER_HOST (the Unix socket by default). Streaming requests use a
+    connection of their own, since Docker holds it until the stream ends.
+    """
+
+    name = 'api'
+
+    def __init__(self, host=None, timeout=60):
+        self.host = host or os.environ.get('DOCKER_HOST',
+                                           'unix:///var/run/docker.sock')
+        self.timeout = timeout
+        self.conn = None
+        # The shared connection carries one request at a time
+        self.lock = threading.Lock()
+        self.prefix = ''
+        self.info = self.request('GET', '/version')
+        self.prefix = '/v' + self.info['ApiVersion']
+
+    def _connect(self, timeout):
+        if self.host.startswith('unix://'):
+            return UnixHTTPConnection(self.host[7:], timeout=timeout)
+        elif self.host.startswith('tcp://'):
+            address = self.host[6:].rstrip('/')
+            if os.environ.get('DOCKER_TLS_VERIFY'):
+                import ssl
+
+                certs = os.environ.get('DOCKER_CERT_PATH',
+                                       os.path.expanduser('~/.docker'))
+                context = ssl.create_default_context(
+                    cafile=os.path.join(certs, 'ca.pem'))
+                context.load_cert_chain(os.path.join(certs, 'cert.pem'),
+                                        os.path.join(certs, 'key.pem'))
+                return httplib.HTTPSConnection(address, timeout=timeout,
+                                               context=context)
+            return httplib.HTTPConnection(address, timeout=timeout)
+
+        raise ValueError('Unsupported DOCKER_HOST ' + self.host)
+
+    def _url(self, path, query):
+        try:
+            from urllib.parse import urlencode, quote
+        except ImportError:
+            from urllib import urlencode, quote
+
+        url = self.prefix + quote(path)
+        if query:
+            url += '?' + urlencode(query)
+        return url
+
+    def request(self, method, path, body=None, query=None, ok=()):
+        """Send a request over the shared connection and decode the reply.
+
+        Status codes in ok are returned as None instead of raising.
+        """
+        import json
+
+        headers = {'Content-Type': 'application/json'}
+        if body is not None:
+            body = json.dumps(body)
+
+        with self.lock:
+            for attempt in range(2):
+                if self.conn is None:
+                    self.conn = self._connect(self.timeout)
+                try:
+                    self.conn.request(method, self._url(path, query), body,
+                                      headers)
+                    resp = self.conn.getresponse()
+                    data = resp.read()
+                    break
+                except (socket.error, httplib.HTTPException):
+                    # The daemon may have closed an idle keep-alive connection
+                    self.conn.close()
+                    self.conn = None
+                    if attempt:
+                        raise
+
+        if resp.status in ok:
+            return None
+        if resp.status >= 400:
+            raise DockerError(resp.status, method + ' ' + path, data)
+        if data and resp.getheader('Content-Type', '').startswith('application/json'):
+            return json.loads(data.decode('utf-8'))
+        return data
+
+    def stream(self, method, path, body=None, query=None):
+        "Send a request over a new connection and return the open response"
+        import json
+
+        conn = self._connect(None)
+        headers = {'Content-Type': 'application/json'}
+        conn.request(method, self._url(path, query),
+                     None if body is None else json.dumps(body), headers)
+        resp = conn.getresponse()
+        if resp.status >= 400:
+            data = resp.read()
+            conn.close()
+            raise DockerError(resp.status, method + ' ' + path, data)
+        return conn, resp
+
+    def version(self):
+        "Return the Docker version"
+        return self.info['Version']
+
+    def host_info(self):
+        "Return the system information of the Docker host, such as NCPU"
+        return self.request('GET', '/info')
+
+    def image_id(self, image):
+        "Return the short ID of a local image, or an empty string"
+        info = self.request('GET', '/images/' + image + '/json', ok=(404,))
+        return info['Id'].split(':')[-1][:12] if info else ''
+
+    def image_digests(self, image):
+        "Return the registry digests of a local image"
+        info = self.request('GET', '/images/' + image + '/json', ok=(404,))
+        return [d.split('@')[-1] for d in (info or {}).get('RepoDigests') or []]
+
+    def dangling_images(self):
+        "Return the short IDs of dangling images"
+        import json
+
+        images = self.request('GET', '/images/json',
+                              query={'filters': json.dumps({'dangling': ['true']})})
+        return [img['Id'].split(':')[-1][:12] for img in images]
+
+    def pull(self, image):
+        "Pull an image and return the exit status"
+        import json
+
+        repo, tag = split_image(image)
+        try:
+            conn, resp = self.stream('POST', '/images/create',
+                                     query={'fromImage': repo, 'tag': tag})
+        except DockerError as e:
+            stderr_write(str(e) + '\n')
+            return e.returncode
+
+        err = 0
+        stream = LineStream(resp, conn, multiplexed=False)
+        for line in iter(stream.readline, ''):
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                continue
+            if 'error' in msg:
+                stderr_write(msg['error'] + '\n')
+                err = -1
+            elif msg.get('status') and 'progress' not in msg:
+                stdout_write((msg['id'] + ': ' if 'id' in msg else '') +
+                             msg['status'] + '\n')
+        stream.close()
+        return err
+
+    def remove_image(self, img):
+        "Remove an image"
+        self.request('DELETE', '/images/' + img, query={'force': 1},
+                     ok=(404, 409))
+
+    def images(self, repo):
+        "Return the tagged images of a repository, with Id, RepoTags and Size"
+        import json
+
+        return self.request('GET', '/images/json', query={
+            'filters': json.dumps({'reference': [repo]})})
+
+    def remove_tag(self, ref):
+        "Remove a tag, and its image if no other tag or container uses it"
+        self.request('DELETE', '/images/' + ref)
+
+    def remove_volume(self, name):
+        "Remove a volume"
+        self.request('DELETE', '/volumes/' + name, query={'force': 1},
+                     ok=(404,))
+
+    def has_volume(self, name):
+        "Check whether a volume exists"
+        return self.request('GET', '/volumes/' + name, ok=(404,)) is not None
+
+    def run(self, spec):
+        "Start a container and return the exit status of docker run"
+        if spec['extra_args']:
+            # Free-form "docker run" arguments only make sense to the CLI
+            return DockerCLI().run(spec)
+
+        ports = {}
+        for host_port, port in spec['ports']:
+            ports[port + '/tcp'] = [{'HostPort': host_port}]
+
+        host_config = {
+            'Binds': spec['binds'],
+            'PortBindings': ports,
+            'ShmSize': parse_size(spec['shm_size']),
+            'NanoCpus': int(float(spec['cpus'] or 0) * 1e9),
+            'Memory': spec['memory'] or 0,
+            'CpusetCpus': spec['cpuset'] or '',
+            'AutoRemove': spec['remove'],
+            'SecurityOpt': spec['security_opt'],
+            'CapAdd': spec['cap_add'],
+            'Devices': [{'PathOnHost': d, 'PathInContainer': d,
+                         'CgroupPermissions': 'rwm'} for d in spec['devices']]}
+        if spec['log_opts']:
+            # An empty type keeps the logging driver of the daemon
+            host_config['LogConfig'] = {'Type': '', 'Config': spec['log_opts']}
+
+        body = {'Image': spec['image'],
+                'Cmd': [spec['command']],
+                'Hostname': spec['hostname'],
+                'Env': spec['env'],
+                'WorkingDir': spec['workdir'],
+                'Tty': not spec['remove'],
+                'Labels': spec['labels'],
+                'ExposedPorts': dict((p, {}) for p in ports),
+                'HostConfig': host_config}
+
+        try:
+            container = self.request('POST', '/containers/create', body,
+                                     query={'name': spec['name']})
+            self.request('POST', '/containers/' + container['Id'] + '/start')
+        except DockerError as e:
+            stderr_write(str(e) + '\n')
+            return e.returncode
+
+        stdout_write(container['Id'] + '\n')
+        return 0
+
+    def _exec(self, container, cmd):
+        return self.request('POST', '/containers/' + container + '/exec',
+                            {'Cmd': cmd, 'AttachStdout': True,
+                             'AttachStderr': True})['Id']
+
+    def exec_output(self, container, cmd):
+        "Run a command in a container and return its output"
+        exec_id = self._exec(container, cmd)
+        conn, resp = self.stream('POST', '/exec/' + exec_id + '/start',
+                                 {'Detach': False, 'Tty': False})
+        stream = LineStream(resp, conn)
+        output = ''.join(iter(stream.readline, ''))
+        stream.close()
+
+        status = self.request('GET', '/exec/' + exec_id + '/json')['ExitCode']
+        if status:
+            raise DockerError(status, ' '.join(cmd), output.encode('utf-8'))
+        return output.encode('utf-8')
+
+    def exec_detached(self, container, cmd):
+        "Start a command in a container without waiting for it"
+        exec_id = self._exec(container, cmd)
+        self.request('POST', '/exec/' + exec_id + '/start',
+                     {'Detach': True, 'Tty': False})
+
+    def exec_stream(self, container, cmd):
+        "Run a command in a container and return a line reader of its output"
+        exec_id = self._exec(container, cmd)
+        conn, resp = self.stream('POST', '/exec/' + exec_id + '/start',
+                                 {'Detach': False, 'Tty': False})
+        return LineStream(resp, conn)
+
+    def exec_pipe(self, container, cmd, user=''):
+        "Run a command in a container and return a pipe to its stdin and stdout"
+        import json
+
+        exec_id = self.request('POST', '/containers/' + container + '/exec',
+                               {'Cmd': cmd, 'User': user, 'AttachStdin': True,
+                                'AttachStdout': True})['Id']
+        conn = self._connect(None)
+        conn.request('POST', self._url('/exec/' + exec_id + '/start', None),
+                     json.dumps({'Detach': False, 'Tty': False}),
+                     {'Content-Type': 'application/json',
+                      'Connection': 'Upgrade', 'Upgrade': 'tcp'})
+        # httplib drops the socket of responses without a length
+        sock = conn.sock
+        resp = conn.getresponse()
+        if resp.status >= 400:
+            data = resp.read()
+            conn.close()
+            raise DockerError(resp.status, 'exec ' + ' '.join(cmd), data)
+        # After the upgrade, the connection carries the raw streams
+        return ExecPipe(resp.fp, conn, sock)
+
+    def follow_logs(self, container, since=None):
+        """Return a line reader that follows the stdout of a container.
+
+        Output before the Unix time since is skipped.
+        """
+        return self.logs(container, follow=True, since=since)
+
+    def logs(self, container, follow=False, since=None):
+        "Return a line reader for the stdout of a container"
+        info = self.request('GET', '/containers/' + container + '/json')
+        query = {'stdout': 1}
+        if follow:
+            query['follow'] = 1
+        if since:
+            query['since'] = since
+        conn, resp = self.stream('GET', '/containers/' + container + '/logs',
+                                 query=query)
+        # Output of containers with a tty is not multiplexed
+        return LineStream(resp, conn, multiplexed=not info['Config']['Tty'])
+
+    def wait(self, container):
+        "Block until the container stops"
+        conn, resp = self.stream('POST', '/containers/' + container + '/wait')
+        resp.read()
+        conn.close()
+
+    def is_running(self, container):
+        "Check whether a container is running"
+        import json
+
+        return bool(self.request('GET', '/containers/json', query={
+            'filters': json.dumps({'name': [container]})}))
+
+    def inspect(self, container):
+        "Return the low-level information on a container"
+        return self.request('GET', '/containers/' + container + '/json')
+
+    def containers(self, label=None):
+        "Return the inspected running containers, with the given label if any"
+        import json
+
+        query = {'filters': json.dumps({'label': [label]})} if label else None
+        found = self.request('GET', '/containers/json', query=query)
+        return [self.inspect(c['Id']) for c in found]
+
+    def rename(self, container, name):
+        "Rename a container"
+        self.request('POST', '/containers/' + container + '/rename',
+                     query={'name': name})
+
+    def pause(self, container):
+        "Pause all processes in a container"
+        self.request('POST', '/containers/' + container + '/pause')
+
+    def unpause(self, container):
+        "Resume a paused container"
+        self.request('POST', '/containers/' + container + '/unpause')
+
+    def remove_container(self, container):
+        "Stop and remove a container, even if it is paused"
+        self.request('DELETE', '/containers/' + container,
+                     query={'force': 1}, ok=(404,))
+
+
+def docker_client(backend):
+    """Return a Docker backend.
+
+    The "auto" backend uses the Engine API when the daemon is reachable
+    and falls back to the docker command-line client otherwise.
+    """
+
+    if backend != 'cli':
+        try:
+            return DockerAPI()
+        except (socket.error, httplib.HTTPException, ValueError, KeyError,
+                DockerError):
+            if backend == 'api':
+                raise
+
+    return DockerCLI()
+
+
+class StartupProfiler(object):
+    """Record how long each phase of a launch takes.
+
+    Call mark() at the end of every phase; the time since the previous
+    mark is charged to that phase.
+    """
+
+    def __init__(self):
+        self.start = self.last = time.time()
+        self.phases = []
+
+    def mark(self, name):
+        "End the current phase and start the next one"
+        now = time.time()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self, path, **fields):
+        """Print a summary table and append a JSON record to path.
+
+        A path of "-" only prints the table.
+        """
+        import json
+        import platform
+
+        total = self.last - self.start
+        stderr_write("\nStartup profile (%.3f seconds in total):\n" % total)
+        for name, seconds in self.phases:
+            stderr_write("    %-24s %8.3f s %5.1f%%\n" %
+                         (name, seconds, 100.0 * seconds / max(total, 1e-9)))
+
+        if path and path != '-':
+            record = {'timestamp': self.start,
+                      'host': platform.node(),
+                      'total': total,
+                      'phases': [{'name': name, 'seconds': seconds}
+                                 for name, seconds in self.phases]}
+            record.update(fields)
+            with open(path, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def handle_interrupt(docker, container):
+    """Handle keyboard interrupt"""
+    try:
+        print("Press Ctrl-C again to stop the server: ")
+        time.sleep(5)
+        print('Invalid response. Resuming...')
+    except KeyboardInterrupt:
+        print('*** Stopping the server.')
+        docker.exec_detached(container, ["killall", "my_init"])
+        sys.exit(0)
+
+
+def check_host():
+    """Check that the current user may run Docker and return the uid"""
+    import platform
+
+    if platform.system() == "Linux":
+        if subprocess.check_output(['groups']).find(b'docker') < 0:
+            raise RuntimeError(
+                'You are not a member of the docker group. Please add\n' +
+                'yourself to the docker group using the following command:\n' +
+                '   sudo addgroup $USER docker\n' +
+                'Then, log out and log back in before you can use Docker.')
+        uid = str(os.getuid())
+        if uid == '0':
+            raise RuntimeError('You are running as root. This is not safe. ' +
+                               'Please run as a regular user.')
+    else:
+        uid = ""
+
+    return uid
+
+
+def preflight(tasks, main_tasks=(), timeout=60, verbose=False):
+    """Run independent checks concurrently and return their results.
+
+    Each task is a tuple of a name, a function and an optional message
+    that replaces the error of the function. tasks run on a thread pool,
+    while main_tasks run on the main thread in the meantime (Tk must not
+    be used from other threads). All tasks share one deadline, and the
+    errors of all failed tasks are reported together before exiting.
+    """
+    from multiprocessing import TimeoutError
+    from multiprocessing.pool import ThreadPool
+
+    def timed(func):
+        start = time.time()
+        try:
+            return func(), None, time.time() - start
+        except Exception as e:
+            return None, e, time.time() - start
+
+    start = time.time()
+    pool = ThreadPool(max(len(tasks), 1))
+    pending = [(task, pool.apply_async(timed, (task[1],))) for task in tasks]
+    done = [(task, timed(task[1])) for task in main_tasks]
+
+    for task, result in pending:
+        try:
+            done.append((task, result.get(max(start + timeout - time.time(), 0))))
+        except TimeoutError:
+            done.append((task, (None, RuntimeError(
+                'Check "%s" did not finish within %g seconds.' %
+                (task[0], timeout)), timeout)))
+    pool.close()
+
+    results = {}
+    errors = []
+    for task, (value, err, seconds) in done:
+        results[task[0]] = value
+        if verbose:
+            stdout_write("    %-10s %.3f s\n" % (task[0], seconds))
+        if err is not None:
+            message = task[2] if len(task) > 2 else str(err)
+            if message not in errors:
+                errors.append(message)
+
+    if verbose:
+        stdout_write("Preflight checks took %.3f s (%.3f s if run one after another).\n" %
+                     (time.time() - start, sum(r[2] for _, r in done)))
+
+    if errors:
+        for message in errors:
+            print(message)
+        sys.exit(-1)
+
+    return results
+
+
+def find_session_ports():
+    "Find free host ports for ssh, http and vnc"
+
+    try:
+        return dict(zip(['ssh', 'http', 'vnc'],
+                        [str(p) for p in PortRegistry().allocate(3)]))
+    except (socket.error, IOError, OSError):
+        raise RuntimeError("Error: Could not find a free port.")
+
+
+def session_spec(args, uid, remove, size, ports, resources=None,
+                 cwd=None):
+    """Build the container spec for a new session.
+
+    remove tells whether Docker supports --rm with -d, size is the desktop
+    size, ports has the host ports for ssh, http and vnc, and resources
+    are from session_resources(). Without resources, the container has no
+    limits. cwd is the shared directory, by default the working
+    directory.
+    """
+    import glob
+
+    pwd = cwd or os.getcwd()
+    homedir = os.path.expanduser('~')
+    config = proj + '_' + args.tag + '_config'
+
+    # --sync keeps the working directory on a volume instead
+    shared = sync_volume(pwd) if args.sync else pwd
+    volumes = [shared + ":" + docker_home + "/shared",
+               config + ":" + docker_home + "/.config"]
+
+    if os.path.exists(homedir + "/.gnupg"):
+        volumes += [homedir + "/.gnupg" + ":" + docker_home + "/.gnupg"]
+
+    # Mount .gitconfig to Docker image
+    if os.path.isfile(homedir + "/.gitconfig"):
+        volumes += [homedir + "/.gitconfig" +
+                    ":" + docker_home + "/.gitconfig_host"]
+
+    if args.volume:
+        volumes += [args.volume + ":" + docker_home + "/" + projdir]
+
+    # The cache volume of the image, which prepare() picks
+    if args.cache:
+        volumes += [args.cache + ":" + docker_home + "/.cache"]
+
+    if args.workdir[0] == '/':
+        workdir = args.workdir
+    else:
+        workdir = docker_home + "/" + args.workdir
+
+    # Generate a container ID
+    container = id_generator()
+
+    envs = ["RESOLUT=" + size,
+            "HOST_UID=" + uid]
+
+    # Create directory .ssh if not exist
+    if not os.path.exists(homedir + "/.ssh"):
+        os.mkdir(homedir + "/.ssh")
+
+    volumes += [homedir + "/.ssh" + ":" + docker_home + "/.ssh"]
+
+    devices = []
+    if args.nvidia:
+        for d in glob.glob('/dev/nvidia*'):
+            devices += [d]
+
+    spec = {'image': args.image,
+            'name': container,
+            'hostname': container,
+            'command': cache_command(args) + "startvnc.sh | " +
+                       log_pipe(docker_home + "/.log/vnc.log",
+                                args.log_max_size),
+            'env': envs,
+            'ports': [(ports['ssh'], "22"), (ports['http'], "6080"),
+                      (ports['vnc'], "5900")],
+            'binds': volumes,
+            'workdir': workdir,
+            'devices': devices,
+            'shm_size': "2g",
+            'cpus': None,
+            'memory': None,
+            'cpuset': None,
+            'log_opts': None,
+            'remove': remove,
+            'security_opt': ['seccomp=unconfined'],
+            'cap_add': ['SYS_PTRACE'],
+            'extra_args': args.args.split(),
+            'labels': session_labels(args, pwd),
+            'profile_env': []}
+
+    resources = dict(resources or {})
+    threads = resources.pop('threads', None)
+    spec.update(resources)
+    if threads:
+        spec['env'] += thread_env(threads)
+        spec['profile_env'] += thread_env(threads)
+    if args.mpi_ranks:
+        spec['env'] += mpi_env(threads)
+        spec['profile_env'] += mpi_env(threads)
+
+    return spec
+
+
+def pool_spec(spec):
+    """Return the spec of a warm container that can serve a session spec.
+
+    The bind mounts of the working directory and of files in the home
+    directory, the user ID and the session labels depend on who launches
+    and from where. Docker cannot add them to a running container, so warm
+    containers start without them. A session that claims one synchronizes
+    its directory into ~/shared as with --sync instead.
+    """
+
+    user_paths = [docker_home + path for path in
+                  ('/shared', '/.ssh', '/.gnupg', '/.gitconfig_host')]
+    spec = dict(spec)
+    spec['binds'] = [b for b in spec['binds']
+                     if not any(b.endswith(':' + p) for p in user_paths)]
+    spec['env'] = [env for env in spec['env']
+                   if not env.startswith('HOST_UID=')]
+    spec['labels'] = dict((k, v) for k, v in spec['labels'].items()
+                          if k not in (label_ns + 'shared', label_ns + 'sync',
+                                       label_ns + 'session'))
+    return spec
+
+
+def pool_key(spec):
+    """Key of the warm pool that can serve a container spec.
+
+    Docker cannot add mounts to a running container, so a warm container
+    can only serve sessions with the same image, shared mounts, workdir and
+    environment. The parts that pool_spec leaves out are ignored, and so
+    are names, ports and the desktop size, which a claim changes, and
+    resources and threads, which are sized when the warm container starts.
+    """
+    import hashlib
+    import json
+
+    spec = pool_spec(spec)
+    fields = dict((k, spec[k]) for k in ('image', 'command', 'binds',
+                                         'workdir', 'devices', 'extra_args'))
+    fields['env'] = [env for env in spec['env']
+                     if env not in spec['profile_env'] and
+                     not env.startswith('RESOLUT=')]
+    return hashlib.sha1(json.dumps(fields, sort_keys=True).
+                        encode('utf-8')).hexdigest()[:12]
+
+
+def published_ports(info):
+    "Return the host ports for ssh, http and vnc of an inspected container"
+
+    names = {'22/tcp': 'ssh', '6080/tcp': 'http', '5900/tcp': 'vnc'}
+    ports = {}
+    for port, bindings in (info['NetworkSettings']['Ports'] or {}).items():
+        if port in names and bindings:
+            ports[names[port]] = bindings[0]['HostPort']
+    return ports
+
+
+def claim_pool_container(docker, key):
+    """Take a warm container out of the pool for a new session.
+
+    Returns the new container name and its ports, or (None, None) if the
+    pool is empty. Renaming is atomic in Docker, so two launches cannot
+    claim the same container.
+    """
+
+    members = sorted(docker.containers(label_ns + 'pool=' + key),
+                     key=lambda c: c['Config']['Labels'].get(label_ns + 'created'))
+    for info in members:
+        name = info['Name'].lstrip('/')
+        if not name.startswith(proj + '-pool-'):
+            continue
+
+        container = id_generator()
+        try:
+            docker.rename(name, container)
+        except subprocess.CalledProcessError:
+            # Another launch took it first
+            continue
+
+        if info['State']['Paused']:
+            docker.unpause(container)
+        return container, published_ports(info)
+
+    return None, None
+
+
+def start_pool_container(docker, spec, paused):
+    """Start a warm container and optionally pause it once it is ready"""
+
+    run_container(docker, spec)
+    if not paused:
+        return
+
+    p = docker.follow_logs(spec['name'])
+    for stdout_line in iter(p.readline, ""):
+        if stdout_line.find("http://localhost:") >= 0:
+            docker.pause(spec['name'])
+            break
+    p.close()
+
+
+def adopt_pool_container(docker, container, args, size):
+    """Fit a warm container that a launch has claimed to its session.
+
+    The desktop is resized to the size of the session, which only works
+    within the size the warm container started with; noVNC scales it down
+    otherwise. The working directory is synchronized into ~/shared, so
+    --sync is turned on for the rest of the launch.
+    """
+
+    docker.exec_output(container, ['mkdir', '-p', docker_home + '/shared'])
+    try:
+        resize_desktop(docker, container, size)
+    except subprocess.CalledProcessError:
+        stderr_write("Warning: could not resize the warm desktop to " +
+                     size + ", so the browser scales it.\n")
+    args.sync = True
+
+def run_pool(docker, args, uid, remove):
+    """Keep a pool of warm containers for new sessions.
+
+    Containers older than --idle-expire are replaced, and at most one new
+    container is started per --refill-interval seconds. Warm containers
+    serve launches by any user and from any directory. Their desktop has
+    the size of -s, so start the pool with the largest screen size.
+    """
+
+    # Probe the screen once rather than for every warm container
+    size = args.size or get_screen_resolution() or "1440x900"
+
+    spec = pool_spec(session_spec(args, uid, remove, size,
+                                  find_session_ports()))
+    key = pool_key(spec)
+    stdout_write('Keeping %d warm containers ready in pool %s.\n' %
+                 (args.pool_size, key))
+
+    last_start = 0
+    while True:
+        now = time.time()
+        ready = 0
+        for info in docker.containers(label_ns + 'pool=' + key):
+            name = info['Name'].lstrip('/')
+            if not name.startswith(proj + '-pool-'):
+                continue
+            created = float(info['Config']['Labels'].get(label_ns + 'created', now))
+            if now - created > args.idle_expire:
+                stdout_write('Expiring idle container ' + name + '.\n')
+                docker.remove_container(name)
+            else:
+                ready += 1
+
+        if ready < args.pool_size and now - last_start >= args.refill_interval:
+            # Every container needs its own ports
+            spec = pool_spec(session_spec(args, uid, remove, size,
+                                          find_session_ports(),
+                                          session_resources(docker, args)[0]))
+            spec['name'] = spec['hostname'] = proj + '-pool-' + \
+                id_generator().split('-')[-1]
+            spec['labels'].update({label_ns + 'pool': key,
+                                   label_ns + 'created': str(now)})
+            stdout_write('Starting warm container %s (%d of %d ready).\n' %
+                         (spec['name'], ready, args.pool_size))
+            start_pool_container(docker, spec, args.paused)
+            last_start = now
+
+        time.sleep(1)
+
+
+def session_labels(args, cwd=None):
+    """Labels that identify the session of a launch.
+
+    Launches with the same image, project volume and shared directory
+    belong to the same session and can reattach to its container. cwd is
+    the shared directory, by default the working directory.
+    """
+    import hashlib
+    import json
+
+    cwd = cwd or os.getcwd()
+    labels = {label_ns + 'kind': 'desktop',
+              label_ns + 'image': args.image,
+              label_ns + 'volume': args.volume,
+              label_ns + 'shared': cwd}
+    if args.sync:
+        labels[label_ns + 'sync'] = sync_volume(cwd)
+    labels[label_ns + 'session'] = hashlib.sha1(
+        json.dumps(labels, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    return labels
+
+
+def find_session(docker, labels):
+    """Find a running container of the same session.
+
+    Returns its name and ports, or (None, None) if there is none.
+    """
+
+    for info in docker.containers(label_ns + 'session=' +
+                                  labels[label_ns + 'session']):
+        name = info['Name'].lstrip('/')
+        if not name.startswith(proj + '-pool-') and \
+                not info['State']['Paused']:
+            return name, published_ports(info)
+
+    return None, None
+
+
+def resize_desktop(docker, container, size):
+    "Resize the X display of a container with xresize and return its output"
+
+    return docker.exec_output(container, [
+        'su', docker_user, '-c', 'DISPLAY=:0 ' + docker_home +
+        '/.local/bin/xresize ' + size])
+
+
+def run_resize(docker, args):
+    """Resize the desktop of the running session.
+
+    Changes the size of the X display in the container of the session
+    with the same image, volume and directory, such as after moving the
+    browser to another screen. The desktop cannot grow beyond the size it
+    started with. Returns the exit status.
+    """
+
+    import re
+
+    size = args.new_size or get_screen_resolution()
+    if not size:
+        stderr_write('No screen found. Please give the new size.\n')
+        return -1
+    if not re.match(r'^\d+x\d+$', size):
+        stderr_write('The size must be WIDTHxHEIGHT, such as 1920x1080.\n')
+        return -1
+
+    container = find_session(docker, session_labels(args))[0]
+    if not container:
+        stderr_write('No running session of ' + args.image + '.\n')
+        return -1
+
+    try:
+        out = resize_desktop(docker, container, size)
+    except subprocess.CalledProcessError as e:
+        stderr_write((e.output or b'').decode('utf-8'))
+        return -1
+    stdout_write(out.decode('utf-8'))
+    return 0
+
+
+class SessionDaemon(object):
+    """Sessions started through the API of the serve command.
+
+    Keeps one Docker client and the URL of each session it started, and
+    lists the other sessions of the launcher from their labels. Sessions
+    are created with the options of a launch, for the directory the client
+    runs in. Requests run on threads of their own, and only the check for a
+    running session and the start of its container are serialized, so that
+    one session does not get two containers. Pulls and waits for the URL
+    run concurrently.
+    """
+
+    def __init__(self, docker):
+        self.docker = docker
+        self.lock = threading.Lock()
+        self.urls = {}
+
+    def handle(self, method, path, body):
+        "Serve a request and return the HTTP status and the JSON reply"
+
+        parts = [p for p in path.split('?')[0].split('/') if p]
+        if parts[:1] != ['sessions'] or len(parts) > 2:
+            return 404, {'error': 'No such resource ' + path}
+        if len(parts) == 1:
+            if method == 'GET':
+                return 200, {'sessions': self.sessions()}
+            if method == 'POST':
+                return self.create(body.get('argv', []),
+                                   body.get('cwd', os.getcwd()))
+            return 405, {'error': 'Use GET or POST on /sessions'}
+
+        session = self.session(parts[1])
+        if not session:
+            return 404, {'error': 'No session ' + parts[1]}
+        if method == 'GET':
+            return 200, session
+        if method == 'DELETE':
+            self.docker.exec_detached(session['name'], ["killall", "my_init"])
+            self.urls.pop(session['name'], None)
+            return 202, session
+        return 405, {'error': 'Use GET or DELETE on /sessions/NAME'}
+
+    def sessions(self):
+        "Return the running sessions of the launcher"
+
+        found = []
+        for info in self.docker.containers(label_ns + 'kind=desktop'):
+            name = info['Name'].lstrip('/')
+            if name.startswith(proj + '-pool-'):
+                continue
+            labels = info['Config']['Labels'] or {}
+            found.append({'name': name,
+                          'image': labels.get(label_ns + 'image'),
+                          'volume': labels.get(label_ns + 'volume'),
+                          'cwd': labels.get(label_ns + 'shared'),
+                          'session': labels.get(label_ns + 'session'),
+                          'paused': info['State']['Paused'],
+                          'started': info['State'].get('StartedAt'),
+                          'ports': published_ports(info),
+                          'url': self.urls.get(name)})
+        return found
+
+    def session(self, name):
+        "Return the running session of a container, or None"
+        for session in self.sessions():
+            if session['name'] == name:
+                return session
+        return None
+
+    def create(self, argv, cwd):
+        """Start a session, or reattach to it, and wait for its URL.
+
+        argv has the options of a launch, which are checked as usual.
+        """
+
+        try:
+            args = parse_args(description=__doc__, argv=argv)
+        except SystemExit:
+            return 400, {'error': 'Invalid options: ' + ' '.join(argv)}
+        if args.sync or args.pool:
+            return 400, {'error': '--sync and --pool need the launcher to ' +
+                         'run on the host, so use --no-daemon.'}
+        if not os.path.isdir(cwd):
+            return 400, {'error': 'No directory ' + cwd}
+
+        labels = session_labels(args, cwd)
+        try:
+            container = None
+            if not args.new:
+                container, ports = find_session(self.docker, labels)
+            created = not container
+            if created:
+                profiler = StartupProfiler()
+                checks = prepare(self.docker, args, profiler)
+                with self.lock:
+                    # Another request may have started it during the pull
+                    if not args.new:
+                        container, ports = find_session(self.docker, labels)
+                    created = not container
+                    if created:
+                        container, ports = start_session(
+                            self.docker, args, checks, profiler, cwd)
+            url = self.wait_for_url(container, ports['http'], args)
+        except (Exception, SystemExit) as e:
+            return 500, {'error': 'Could not start the session: ' + str(e)}
+
+        self.urls[container] = url
+        # A container that has just started may not be listed yet
+        session = self.session(container) or {'name': container}
+        session.update({'url': url, 'created': created, 'ports': ports,
+                        'password': url[url.find('password=') + 9:]
+                        .split('&')[0] if 'password=' in url else None})
+        return 201 if created else 200, session
+
+    def wait_for_url(self, container, port_http, args):
+        "Follow the log of a session until its noVNC URL appears"
+
+        log = LogBuffer(args.log_lines, args.log_level)
+        p = self.docker.follow_logs(container)
+        try:
+            for line in iter(p.readline, ""):
+                ind = line.find("http://localhost:")
+                if ind >= 0:
+                    url = line[ind:].replace(":6080/", ':' + port_http + "/")
+                    url = vnc_url(url, vnc_settings(args, port_http))
+                    return url.strip()
+                log.add(line)
+        finally:
+            p.close()
+        raise RuntimeError('the container exited. The last lines of its ' +
+                           'log were:\n' + log.tail())
+
+
+def run_serve(docker, args):
+    """Run a local daemon that starts and manages sessions over HTTP.
+
+    The API takes and returns JSON:
+        GET /sessions           list the running sessions
+        POST /sessions          start a session, or reattach to it, with
+                                {"argv": [launch options], "cwd": dir}
+        GET /sessions/NAME      inspect a session
+        DELETE /sessions/NAME   stop a session
+    Requests need the header "Authorization: Bearer TOKEN", with the token
+    from the state file that the daemon writes on startup. While the daemon
+    runs, plain launches of this launcher go through it.
+    """
+    import binascii
+    import hmac
+    import json
+
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+
+    daemon = SessionDaemon(docker)
+    token = binascii.hexlify(os.urandom(16)).decode('ascii')
+    expected = 'Bearer ' + token
+    verbose = args.verbose
+
+    class Handler(BaseHTTPRequestHandler):
+        "Pass the requests of the API to the session daemon"
+
+        def reply(self, status, data):
+            body = json.dumps(data, indent=1).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def serve(self):
+            auth = self.headers.get('Authorization') or ''
+            if not hmac.compare_digest(auth.encode('utf-8'),
+                                       expected.encode('utf-8')):
+                return self.reply(401, {'error': 'Invalid token'})
+            try:
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length).decode('utf-8')
+                                  or '{}')
+            except ValueError:
+                return self.reply(400, {'error': 'Invalid JSON'})
+            try:
+                self.reply(*daemon.handle(self.command, self.path, body))
+            except (subprocess.CalledProcessError, socket.error,
+                    httplib.HTTPException) as e:
+                self.reply(500, {'error': 'Docker failed: ' + str(e)})
+
+        do_GET = do_POST = do_DELETE = serve
+
+        def log_message(self, format, *args):
+            if verbose:
+                BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server((args.bind, args.port), Handler)
+    host, port = server.server_address[:2]
+
+    # Only the user may read the token
+    path = state_path('serve.json')
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'url': 'http://%s:%d' % (host, port), 'token': token,
+                   'pid': os.getpid()}, f)
+
+    stdout_write('Serving sessions at http://%s:%d. The token is in %s.\n' %
+                 (host, port, path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    return 0
+
+
+def daemon_request(daemon, method, path, body=None):
+    """Send a request to the session daemon.
+
+    daemon is the content of its state file. Returns the status and the
+    JSON reply, or raises socket.error if the daemon is not running.
+    """
+    import json
+
+    host, port = daemon['url'].split('//')[1].rsplit(':', 1)
+    conn = httplib.HTTPConnection(host, int(port), timeout=600)
+    try:
+        conn.request(method, path,
+                     json.dumps(body).encode('utf-8') if body else None,
+                     {'Authorization': 'Bearer ' + daemon['token'],
+                      'Content-Type': 'application/json'})
+        resp = conn.getresponse()
+        return resp.status, json.loads(resp.read().decode('utf-8') or '{}')
+    finally:
+        conn.close()
+
+
+def find_daemon():
+    "Return the state of the running session daemon, or None"
+    import json
+
+    try:
+        with open(os.path.join(statedir, 'serve.json')) as f:
+            daemon = json.load(f)
+        status = daemon_request(daemon, 'GET', '/sessions')[0]
+    except (IOError, ValueError, KeyError, socket.error,
+            httplib.HTTPException):
+        return None
+    return daemon if status == 200 else None
+
+
+def run_client(daemon, args, argv):
+    """Launch a session through the session daemon.
+
+    Behaves like a launch without the daemon: opens the browser, and stops
+    the session on Ctrl-C unless --detach is given. Returns the exit status.
+    """
+    import webbrowser
+
+    size = args.size or get_screen_resolution()
+    if size and not args.size:
+        # The daemon may have no screen of its own
+        argv = argv + ['-s', size]
+    if 'auto' in (args.vnc_quality, args.vnc_compression):
+        # The daemon does not see the ssh connection of this launcher, so
+        # pass it the settings for the link instead of auto
+        settings = auto_vnc_settings(args)
+        options = ('--vnc-quality', '--vnc-compression')
+        kept = []
+        for arg in argv:
+            if arg == 'auto' and kept and kept[-1] in options:
+                kept.pop()
+            elif arg not in [option + '=auto' for option in options]:
+                kept.append(arg)
+        argv = kept
+        for key in ('quality', 'compression'):
+            if settings[key] is not None:
+                argv += ['--vnc-' + key, str(settings[key])]
+    status, session = daemon_request(daemon, 'POST', '/sessions',
+                                     {'argv': argv, 'cwd': os.getcwd()})
+    if status not in (200, 201):
+        stderr_write(session.get('error', 'Error %d' % status) + '\n')
+        return -1
+
+    name = session['name']
+    if status == 200:
+        stdout_write("Reattaching to running container " + name +
+                     ". Use --new to start another one.\n")
+    stdout_write(session['url'] + '\n')
+    stdout_write("For a better experience, use VNC Viewer (" +
+                 'http://realvnc.com/download/viewer)\n' +
+                 "to connect to localhost:%s with password %s\n" %
+                 (session['ports'].get('vnc'), session['password']))
+    if size and not args.no_browser:
+        webbrowser.open(session['url'])
+
+    if args.detach:
+        print('Started container ' + name + ' through the daemon.')
+        print('To stop it, use "docker stop ' + name + '".')
+        return 0
+
+    print("Press Ctrl-C to stop the server.")
+    while True:
+        try:
+            while daemon_request(daemon, 'GET', '/sessions/' + name)[0] == 200:
+                time.sleep(2)
+            stdout_write('Docker container ' + name +
+                         ' is no longer running\n')
+            return -1
+        except (socket.error, httplib.HTTPException):
+            stderr_write('The session daemon stopped.\n')
+            return -1
+        except KeyboardInterrupt:
+            try:
+                print("Press Ctrl-C again to stop the server: ")
+                time.sleep(5)
+                print('Invalid response. Resuming...')
+            except KeyboardInterrupt:
+                print('*** Stopping the server.')
+                daemon_request(daemon, 'DELETE', '/sessions/' + name)
+                return 0
+
+
+def prepare(docker, args, profiler):
+    """Run the preflight checks and pull the image if needed.
+
+    Returns the results of the checks, with the uid in host and whether
+    Docker supports --rm with -d in remove.
+    """
+
+    docker_failed = "Docker failed. Please make sure docker was properly " + \
+        "installed and has been started."
+
+    # These checks do not depend on each other, so run them concurrently
+    checks = preflight([('host', check_host),
+                        ('image', lambda: docker.image_id(args.image),
+                         docker_failed),
+                        ('version', docker.version, docker_failed),
+                        ('ports', find_session_ports),
+                        ('resources', lambda: session_resources(docker, args))],
+                       [] if args.size else
+                       [('screen', get_screen_resolution)],
+                       verbose=args.verbose)
+    img = checks['image']
+    # Docker 1.x cannot combine --rm with -d
+    checks['remove'] = not checks['version'].startswith("1.")
+    profiler.mark('preflight checks')
+
+    pull = args.pull or not img
+    if pull:
+        # Ask the registry first, since most pulls would not change anything
+        pull = pull_needed(args.image, docker.image_digests(args.image)
+                           if img else [], args.verbose)
+        profiler.mark('check registry')
+
+    if pull:
+        if img and args.pull_background:
+            stdout_write("Pulling " + args.image + " in the background. " +
+                         "This launch uses the current image.\n")
+            pull_in_background(docker, args.image)
+            args.cache = cache_volume(docker, args)
+            record_image_use(args.image)
+            return checks
+
+        try:
+            if args.verbose:
+                stdout_write("Pulling latest docker image " +
+                             args.image + '.\n')
+            err = docker.pull(args.image)
+        except BaseException:
+            err = -1
+
+        if err:
+            sys.exit(err)
+
+        # Delete dangling image
+        if img and img in docker.dangling_images():
+            docker.remove_image(img)
+        profiler.mark('docker pull')
+
+    args.cache = cache_volume(docker, args)
+    record_image_use(args.image)
+    return checks
+
+
+def start_session(docker, args, checks, profiler, cwd=None):
+    """Start a container for a new session, or claim one from the pool.
+
+    cwd is the shared directory, by default the working directory. Returns
+    the container name and its ports.
+    """
+
+    config = proj + '_' + args.tag + '_config'
+
+    if args.reset:
+        try:
+            if args.verbose:
+                stdout_write("Removing old docker volume " + config + ".\n")
+            docker.remove_volume(config)
+        except subprocess.CalledProcessError as e:
+            stderr_write(e.output.decode('utf-8'))
+
+    if seed_config(docker, args, config):
+        profiler.mark('clone golden config')
+
+    if args.volume and args.clear:
+        try:
+            if args.verbose:
+                stdout_write(
+                    "Removing old docker volume " + config + ".\n")
+            docker.remove_volume(args.volume)
+        except subprocess.CalledProcessError as e:
+            stderr_write(e.output.decode('utf-8'))
+
+    # Determine size of the desktop
+    size = args.size or checks['screen']
+    if not size:
+        # Set default size and disable webbrowser
+        stderr_write("No screen found, so the desktop is 1440x900 and no " +
+                     "browser is opened. Use -s to set the size.\n")
+        size = "1440x900"
+        args.no_browser = True
+
+    stderr_write("Starting up docker image...\n")
+    ports = checks['ports']
+    spec = session_spec(args, checks['host'], checks['remove'], size, ports,
+                        checks['resources'][0], cwd)
+
+    if args.pool:
+        container, pool_ports = claim_pool_container(docker, pool_key(spec))
+        if container:
+            if args.verbose:
+                stdout_write("Using warm container from the pool.\n")
+            adopt_pool_container(docker, container, args, size)
+            profiler.mark('claim warm container')
+            return container, pool_ports
+
+    cmd = run_command(spec)
+
+    if args.verbose:
+        stdout_write(' '.join(cmd[:-1]) + ' "' + cmd[-1] + '"\n')
+
+    run_container(docker, spec)
+    profiler.mark('docker run')
+
+    return spec['name'], ports
+
+
+if __name__ == "__main__":
+    import webbrowser
+
+    profiler = StartupProfiler()
+    commands = {'pool': run_pool, 'gc': collect_images,
+                'snapshot': run_snapshot, 'restore': run_restore,
+                'golden': run_golden, 'resize': run_resize,
+                'serve': run_serve}
+    command = sys.argv[1] if len(sys.argv) > 1 and \
+        sys.argv[1] in commands else None
+    if command:
+        args = parse_args(description=commands[command].__doc__,
+                          argv=sys.argv[2:], command=command)
+    else:
+        args = parse_args(description=__doc__)
+
+    if args.quiet:
+        def print(*args, **kwargs):
+            "Do nothing"
+            pass
+
+        def stdout_write(*args, **kwargs):
+            "Do nothing"
+            pass
+
+        def stderr_write(*args, **kwargs):
+            "Do nothing"
+            pass
+    else:
+        def stdout_write(*args, **kwargs):
+            "Call sys.stderr.write"
+            sys.stdout.write(*args, **kwargs)
+
+        def stderr_write(*args, **kwargs):
+            "Call sys.stderr.write"
+            sys.stderr.write(*args, **kwargs)
+
+    homedir = os.path.expanduser('~')
+
+    # Options that need this process, such as for a report, skip the daemon
+    if not command and not (args.no_daemon or args.sync or args.pool or
+                            args.mpi_test or args.vnc_report or
+                            args.profile_startup is not None):
+        daemon = find_daemon()
+        if daemon:
+            if args.verbose:
+                stdout_write("Using the session daemon at " +
+                             daemon['url'] + ".\n")
+            sys.exit(run_client(daemon, args, sys.argv[1:]))
+
+    try:
+        if args.verbose:
+            stdout_write("Check whether Docker is up and running.\n")
+        docker = docker_client(args.backend)
+        if args.verbose:
+            stdout_write("Using the Docker " + docker.name + " backend.\n")
+    except:
+        stderr_write("Docker failed. Please make sure docker was properly " +
+                     "installed and has been started.\n")
+        sys.exit(-1)
+    profiler.mark('docker connect')
+
+    if command == 'pool':
+        checks = prepare(docker, args, profiler)
+        try:
+            run_pool(docker, args, checks['host'], checks['remove'])
+        except KeyboardInterrupt:
+            sys.exit(0)
+
+    if command == 'gc':
+        sys.exit(0 if collect_images(docker, args.image,
+                                     parse_size(args.image_budget),
+                                     args.dry_run) else -1)
+
+    if command == 'snapshot':
+        sys.exit(run_snapshot(docker, args))
+
+    if command == 'restore':
+        sys.exit(run_restore(docker, args))
+
+    if command == 'resize':
+        sys.exit(run_resize(docker, args))
+
+    if command == 'serve':
+        sys.exit(run_serve(docker, args))
+
+    if command == 'golden':
+        checks = prepare(docker, args, profiler)
+        spec = session_spec(args, checks['host'], checks['remove'],
+                            args.size or checks['screen'] or
+                            "1440x900", checks['ports'])
+        sys.exit(run_golden(docker, args, spec))
+
+    container = None
+    if not args.new:
+        try:
+            container, ports = find_session(docker, session_labels(args))
+        except (OSError, socket.error, httplib.HTTPException,
+                subprocess.CalledProcessError):
+            # The CLI backend only finds out here that Docker is missing
+            stderr_write("Docker failed. Please make sure docker was " +
+                         "properly installed and has been started.\n")
+            sys.exit(-1)
+        if container:
+            stdout_write("Reattaching to running container " + container +
+                         ". Use --new to start another one.\n")
+            profiler.mark('find running session')
+
+    if not container:
+        checks = prepare(docker, args, profiler)
+        container, ports = start_session(docker, args, checks, profiler)
+
+    port_ssh, port_http, port_vnc = ports['ssh'], ports['http'], ports['vnc']
+    wait_for_url = True
+    log = LogBuffer(args.log_lines, args.log_level)
+    log_since = None
+
+    # Wait for user to press Ctrl-C
+    while True:
+        try:
+            if wait_for_url:
+                # The container command tees its log to stdout, so follow
+                # the container output instead of polling the log file
+                p = docker.follow_logs(container, since=log_since)
+
+                # Monitor the stdout to extract the URL
+                for stdout_line in iter(p.readline, ""):
+                    ind = stdout_line.find("http://localhost:")
+
+                    if ind >= 0:
+                        profiler.mark('wait for URL')
+
+                        # Open browser if found URL
+                        url = stdout_line.replace(":6080/",
+                                                  ':' + port_http + "/")
+                        passwd = url[url.find('password=') + 9:]
+
+                        settings = vnc_settings(args, port_http)
+                        url = vnc_url(url, settings)
+                        stdout_write(url)
+
+                        stdout_write("\nFor a better experience, use VNC Viewer (" +
+                                     'http://realvnc.com/download/viewer)\n' +
+                                     "to connect to localhost:%s with password %s\n" %
+                                     (port_vnc, passwd))
+
+                        stdout_write("You can also log into the container using the command\n    ssh -X -p " + port_ssh + " " +
+                                     docker_user + "@localhost -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no\n" +
+                                     "with an authorized key in " +
+                                     homedir + "/.ssh/authorized_keys.\n")
+
+                        if args.sync:
+                            start_sync(docker, container)
+                            profiler.mark('initial sync')
+
+                        if not args.no_browser:
+                            path = '/' + url[ind:-1].split('/', 3)[3].split('?')[0]
+                            if not wait_http_service(port_http, path,
+                                                     args.ready_timeout):
+                                stderr_write("Warning: noVNC is not responding yet.\n")
+                            profiler.mark('wait for service')
+                            webbrowser.open(url[ind:-1])
+                            profiler.mark('open browser')
+
+                        if args.mpi_test:
+                            report_mpi_test(docker, container)
+                            profiler.mark('mpi self-test')
+
+                        if args.vnc_report:
+                            report_vnc(docker, container, settings,
+                                       args.vnc_report)
+                            profiler.mark('vnc report')
+
+                        wait_for_url = False
+                        if args.profile_startup is not None:
+                            profiler.report(args.profile_startup,
+                                            image=args.image,
+                                            backend=docker.name,
+                                            launcher=os.path.basename(sys.argv[0]))
+                        break
+                    elif log.add(stdout_line):
+                        stdout_write(stdout_line)
+
+                p.close()
+                if wait_for_url:
+                    # The output ended before the URL appeared. Follow
+                    # only the output after it next time, not the whole log
+                    log_since = int(time.time())
+                    raise DockerError(-1, 'docker logs ' + container)
 
             if args.detach:
                 print('Started container ' + container + ' in background.')
@@ -444,8 +4865,7 @@ if __name__ == "__main__":
             time.sleep(1)
 
             # Wait until the container exits or Ctlr-C is pressed
-            subprocess.check_output(["docker", "exec", container,
-                                     "tail", "-f", "/dev/null"])
+            docker.wait(container)
             sys.exit(0)
 
         except subprocess.CalledProcessError:
@@ -454,11 +4874,12 @@ if __name__ == "__main__":
                 if args.verbose:
                     stdout_write(
                         "Check whether docker container is running.\n")
-                if not subprocess.check_output(['docker', 'ps',
-                                                '-q', '-f',
-                                                'name=' + container]):
+                if not docker.is_running(container):
                     stdout_write('Docker container ' +
                                  container + ' is no longer running\n')
+                    if log.lines:
+                        stdout_write('The last lines of its log were:\n' +
+                                     log.tail())
                     sys.exit(-1)
                 else:
                     time.sleep(1)
@@ -468,10 +4889,10 @@ if __name__ == "__main__":
                              container + ' is no longer running\n')
                 sys.exit(-1)
             except KeyboardInterrupt:
-                handle_interrupt(container)
+                handle_interrupt(docker, container)
 
             continue
         except KeyboardInterrupt:
-            handle_interrupt(container)
+            handle_interrupt(docker, container)
         except OSError:
             sys.exit(-1)
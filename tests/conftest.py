@@ -0,0 +1,45 @@
+"""
+Fixtures for the tests of the launchers.
+
+The launchers are single-file scripts that users download, so the tests
+load them by path rather than import them from a package.
+"""
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_launcher(name):
+    "Load a launcher script as a module, as if it were run as name"
+
+    argv = sys.argv
+    sys.argv = [name]
+    try:
+        spec = importlib.util.spec_from_file_location(
+            name[:-3], os.path.join(root, name))
+        module = importlib.util.module_from_spec(spec)
+        # inspect.getsource, which the --sync agent uses, looks it up here
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+    finally:
+        sys.argv = argv
+
+    # The launchers define these in their main block. Look the streams up
+    # on each call, so that pytest can capture them
+    module.stdout_write = lambda *args: sys.stdout.write(*args)
+    module.stderr_write = lambda *args: sys.stderr.write(*args)
+    return module
+
+
+@pytest.fixture
+def desktop(tmp_path, monkeypatch):
+    "spyder_desktop.py, with its state directory in a temporary directory"
+
+    module = load_launcher('spyder_desktop.py')
+    monkeypatch.setattr(module, 'statedir', str(tmp_path / 'state'))
+    return module
@@ -0,0 +1,181 @@
+"""
+Tests of the registry check that skips pulls of up-to-date images.
+
+Most tests run against a small in-process registry that speaks the part of
+the registry v2 API the launcher uses, including the bearer token flow of
+Docker Hub. test_local_registry runs against a real registry:2 container
+and is skipped without Docker. To run it by hand:
+
+    python -m pytest tests/test_registry.py -k local_registry
+
+It starts registry:2 on a free port, pushes busybox to it and removes the
+registry again.
+"""
+
+import json
+import shutil
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+DIGEST = 'sha256:' + 'ab' * 32
+PLATFORM_DIGEST = 'sha256:' + 'cd' * 32
+LIST_TYPE = 'application/vnd.docker.distribution.manifest.list.v2+json'
+MANIFEST_TYPE = 'application/vnd.docker.distribution.manifest.v2+json'
+
+
+class FakeRegistry(object):
+    """Registry v2 server with one multi-platform tag, test/app:latest.
+
+    Manifests need a bearer token, which /token hands out to anyone.
+    requests records the method and path of every manifest request.
+    """
+
+    def __init__(self):
+        self.requests = []
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send(self, status, body=b'', headers=None):
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.startswith('/token?'):
+                    body = json.dumps({'token': 'secret'}).encode('utf-8')
+                    return self.send(200, body)
+                registry.requests.append((self.command, self.path))
+
+                if self.headers.get('Authorization') != 'Bearer secret':
+                    realm = 'http://127.0.0.1:%d/token' % registry.port
+                    return self.send(401, headers={
+                        'WWW-Authenticate': 'Bearer realm="%s",service="fake"'
+                        ',scope="repository:test/app:pull"' % realm})
+
+                if self.path == '/v2/test/app/manifests/latest':
+                    body = {'manifests': [
+                        {'digest': PLATFORM_DIGEST,
+                         'platform': {'architecture': arch, 'os': 'linux'}}
+                        for arch in ('amd64', 'arm64', 'ppc64le')]}
+                    return self.send(200, json.dumps(body).encode('utf-8'),
+                                     {'Content-Type': LIST_TYPE,
+                                      'Docker-Content-Digest': DIGEST})
+                if self.path == '/v2/test/app/manifests/' + PLATFORM_DIGEST:
+                    body = {'config': {'size': 1000},
+                            'layers': [{'size': 2000}, {'size': 3000}]}
+                    return self.send(200, json.dumps(body).encode('utf-8'),
+                                     {'Content-Type': MANIFEST_TYPE})
+                self.send(404)
+
+            do_HEAD = do_GET
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def registry():
+    server = FakeRegistry()
+    yield server
+    server.close()
+
+
+def test_digest_uses_head_with_token(desktop, registry):
+    client = desktop.Registry('localhost:%d/test/app' % registry.port)
+    assert (client.host, client.repo, client.tag) == \
+        ('localhost:%d' % registry.port, 'test/app', 'latest')
+    assert not client.secure
+
+    assert client.digest() == DIGEST
+    # The first request is refused for want of a token, the retry has one
+    assert registry.requests == [('HEAD', '/v2/test/app/manifests/latest')] * 2
+
+
+def test_download_size_of_platform(desktop, registry):
+    client = desktop.Registry('localhost:%d/test/app:latest' % registry.port)
+    assert client.download_size() == 6000
+
+
+def test_pull_not_needed_for_matching_digest(desktop, registry):
+    image = 'localhost:%d/test/app' % registry.port
+    assert desktop.pull_needed(image, [DIGEST]) is False
+    # Only HEAD requests, which Docker Hub does not count as pulls
+    assert set(m for m, _ in registry.requests) == {'HEAD'}
+
+
+def test_pull_needed_for_other_digest(desktop, registry, capsys):
+    image = 'localhost:%d/test/app' % registry.port
+    assert desktop.pull_needed(image, ['sha256:' + '00' * 32]) is True
+    assert 'transfers up to 5.9 KB' in capsys.readouterr().out
+
+
+def test_pull_needed_without_registry(desktop, capsys):
+    assert desktop.pull_needed('localhost:1/test/app', [DIGEST]) is True
+    assert 'Could not check the registry' in capsys.readouterr().err
+
+
+def test_docker_hub_names(desktop):
+    client = desktop.Registry('ubuntu:18.04')
+    assert (client.host, client.repo, client.tag) == \
+        ('registry-1.docker.io', 'library/ubuntu', '18.04')
+    assert client.secure
+    client = desktop.Registry('compdatasci/spyder-desktop')
+    assert (client.repo, client.tag) == ('compdatasci/spyder-desktop', 'latest')
+
+
+def docker(*args):
+    return subprocess.check_output(('docker',) + args).decode('utf-8').strip()
+
+
+def test_local_registry(desktop):
+    "Compare the registry digest with the local one for an image in registry:2"
+
+    if not shutil.which('docker'):
+        pytest.skip('Docker is not installed')
+    try:
+        docker('pull', 'registry:2')
+        docker('pull', 'busybox:latest')
+    except subprocess.CalledProcessError:
+        pytest.skip('Cannot pull registry:2 and busybox')
+
+    container = docker('run', '-d', '--rm', '-p', '127.0.0.1::5000',
+                       'registry:2')
+    port = docker('port', container, '5000/tcp').rsplit(':', 1)[1]
+    image = 'localhost:%s/spyder-test/busybox:latest' % port
+    try:
+        docker('tag', 'busybox:latest', image)
+        for _ in range(50):
+            try:
+                docker('push', image)
+                break
+            except subprocess.CalledProcessError:
+                # The registry is still starting
+                time.sleep(0.2)
+        else:
+            pytest.fail('Could not push to registry:2')
+
+        digests = desktop.DockerCLI().image_digests(image)
+        assert desktop.Registry(image).digest() in digests
+        assert desktop.pull_needed(image, digests) is False
+        assert desktop.pull_needed(image, []) is True
+    finally:
+        docker('rm', '-f', container)
+        subprocess.call(['docker', 'rmi', image])
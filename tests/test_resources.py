@@ -0,0 +1,64 @@
+"""
+Tests of session_resources, which sizes the CPUs, memory and cpuset of new
+sessions from the Docker host and the sessions running on it.
+"""
+
+import argparse
+
+
+class FakeDocker(object):
+    "A Docker host with ncpu CPUs and containers pinned to cpusets"
+
+    def __init__(self, ncpu, cpusets=()):
+        self.ncpu = ncpu
+        self.running = [{'HostConfig': {'CpusetCpus': cpuset}}
+                        for cpuset in cpusets]
+
+    def host_info(self):
+        return {'NCPU': self.ncpu, 'MemTotal': 16 << 30}
+
+    def containers(self, label):
+        return self.running
+
+
+def options(**kwargs):
+    values = dict(cpus='none', memory='none', cpuset='none', shm_size='auto',
+                  threads='auto', mpi_ranks=0, log_max_size='10m')
+    values.update(kwargs)
+    return argparse.Namespace(**values)
+
+
+def test_limits_are_opt_in(desktop):
+    resources = desktop.session_resources(FakeDocker(8), options())[0]
+    assert (resources['cpus'], resources['memory'], resources['cpuset']) == \
+        (None, None, None)
+    assert resources['threads'] == 8
+    assert resources['shm_size'] == '2048m'
+
+
+def test_auto_cpuset_without_cpu_count(desktop, monkeypatch):
+    monkeypatch.setattr(desktop, 'numa_nodes', lambda ncpu: [range(ncpu)])
+    docker = FakeDocker(8, ['0-3'])
+    resources = desktop.session_resources(docker, options(cpuset='auto'))
+
+    # Two sessions share the host, so the new one gets the other half
+    assert resources[0]['cpus'] is None
+    assert resources[0]['cpuset'] == '4-7'
+    assert resources[0]['threads'] == 4
+
+
+def test_auto_cpuset_of_several_sessions(desktop, monkeypatch):
+    monkeypatch.setattr(desktop, 'numa_nodes', lambda ncpu: [range(ncpu)])
+    resources = desktop.session_resources(FakeDocker(8),
+                                          options(cpuset='auto'), count=4)
+    cpusets = [desktop.parse_cpuset(r['cpuset']) for r in resources]
+    assert all(len(cpus) == 2 for cpus in cpusets)
+    assert len(set(cpu for cpus in cpusets for cpu in cpus)) == 8
+
+
+def test_auto_cpus_with_mpi_ranks(desktop):
+    resources = desktop.session_resources(
+        FakeDocker(8, ['0-3', '4-7', '0-7']),
+        options(cpus='auto', mpi_ranks=4))[0]
+    assert resources['cpus'] == '4'
+    assert resources['threads'] == 1
@@ -0,0 +1,264 @@
+"""
+Tests of the --sync engine: the three-way merge of SyncEngine between two
+SyncAgent directories, the agent program that runs in the container, and
+the inotify watcher. They need only a temporary directory, and the watcher
+tests need Linux.
+"""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+def write(path, text, mtime=None):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(text)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def listing(root):
+    "Return the synchronized files under root, without the private ones"
+    found = set()
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if not name.startswith('.sync-'):
+                path = os.path.join(dirpath, name)
+                found.add(os.path.relpath(path, root).replace(os.sep, '/'))
+    return found
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    host, remote = tmp_path / 'host', tmp_path / 'remote'
+    host.mkdir()
+    remote.mkdir()
+    return str(host), str(remote), str(tmp_path / 'index.json')
+
+
+def engine(desktop, host, remote, index):
+    return desktop.SyncEngine(desktop.SyncAgent(host),
+                              desktop.SyncAgent(remote), index)
+
+
+def test_first_sync_merges_both_ways(desktop, dirs):
+    host, remote, index = dirs
+    write(os.path.join(host, 'a.txt'), 'host')
+    write(os.path.join(remote, 'b', 'c.txt'), 'remote')
+
+    sync = engine(desktop, host, remote, index)
+    assert sync.sync() == 2
+    assert listing(host) == listing(remote) == {'a.txt', 'b/c.txt'}
+    assert read(os.path.join(host, 'b', 'c.txt')) == 'remote'
+    assert sync.sync() == 0
+
+
+def test_changes_and_removals_propagate(desktop, dirs):
+    host, remote, index = dirs
+    write(os.path.join(host, 'a.txt'), 'one')
+    write(os.path.join(host, 'd', 'e.txt'), 'two')
+    sync = engine(desktop, host, remote, index)
+    sync.sync()
+
+    write(os.path.join(host, 'a.txt'), 'changed')
+    os.remove(os.path.join(remote, 'd', 'e.txt'))
+    assert sync.sync() == 2
+    assert read(os.path.join(remote, 'a.txt')) == 'changed'
+    assert listing(host) == {'a.txt'}
+    # The directory that the removal left empty goes as well
+    assert not os.path.exists(os.path.join(host, 'd'))
+
+
+def test_executable_bit_and_mtime(desktop, dirs):
+    host, remote, index = dirs
+    script = os.path.join(host, 'run.sh')
+    write(script, '#!/bin/sh\n', mtime=1500000000)
+    os.chmod(script, 0o755)
+    engine(desktop, host, remote, index).sync()
+
+    st = os.stat(os.path.join(remote, 'run.sh'))
+    assert st.st_mode & 0o111
+    assert int(st.st_mtime) == 1500000000
+
+
+def test_conflict_keeps_newer_and_copies_older(desktop, dirs):
+    host, remote, index = dirs
+    write(os.path.join(host, 'notes.txt'), 'base')
+    sync = engine(desktop, host, remote, index)
+    sync.sync()
+
+    write(os.path.join(host, 'notes.txt'), 'host edit', mtime=2000000000)
+    write(os.path.join(remote, 'notes.txt'), 'remote edit', mtime=2000000100)
+    sync.sync()
+
+    assert sync.stats['conflicts'] == 1
+    for root in (host, remote):
+        assert read(os.path.join(root, 'notes.txt')) == 'remote edit'
+        copies = [p for p in listing(root) if '.sync-conflict-' in p]
+        assert len(copies) == 1 and copies[0].endswith('.txt')
+        assert read(os.path.join(root, copies[0])) == 'host edit'
+
+
+def test_change_wins_over_removal(desktop, dirs):
+    host, remote, index = dirs
+    write(os.path.join(host, 'a.txt'), 'base')
+    sync = engine(desktop, host, remote, index)
+    sync.sync()
+
+    write(os.path.join(host, 'a.txt'), 'edited')
+    os.remove(os.path.join(remote, 'a.txt'))
+    sync.sync()
+    assert read(os.path.join(remote, 'a.txt')) == 'edited'
+
+
+def test_index_resumes_with_the_same_remote(desktop, dirs):
+    host, remote, index = dirs
+    write(os.path.join(host, 'a.txt'), 'a')
+    write(os.path.join(host, 'b.txt'), 'b')
+    engine(desktop, host, remote, index).sync()
+
+    # Removed while the launcher was not running
+    os.remove(os.path.join(host, 'a.txt'))
+    engine(desktop, host, remote, index).sync()
+    assert listing(remote) == {'b.txt'}
+
+
+def test_new_remote_is_merged_without_removals(desktop, dirs, tmp_path):
+    host, remote, index = dirs
+    write(os.path.join(host, 'a.txt'), 'a')
+    engine(desktop, host, remote, index).sync()
+
+    # A new volume has none of the files, but that is not a removal
+    other = str(tmp_path / 'other')
+    os.mkdir(other)
+    write(os.path.join(other, 'b.txt'), 'b')
+    engine(desktop, host, other, index).sync()
+    assert listing(host) == listing(other) == {'a.txt', 'b.txt'}
+
+
+class ProcessPipe(object):
+    "The stdin and stdout of an agent process, as exec_pipe returns them"
+
+    def __init__(self, proc):
+        self.proc = proc
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+        self.proc.stdin.flush()
+
+    def readline(self):
+        return self.proc.stdout.readline()
+
+
+def test_agent_program_over_a_pipe(desktop, dirs):
+    "The agent runs from its source, as in the container"
+    host, remote, index = dirs
+    write(os.path.join(host, 'a.txt'), 'host')
+    write(os.path.join(remote, 'big.bin'), 'x' * (3 * desktop.SyncAgent.chunk))
+
+    program = desktop.agent_program(desktop.SyncAgent, desktop.ChangeWatcher)
+    proc = subprocess.Popen([sys.executable, '-c', program, remote],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            universal_newlines=True)
+    try:
+        peer = desktop.AgentPeer(ProcessPipe(proc))
+        sync = desktop.SyncEngine(desktop.SyncAgent(host), peer, index)
+        assert sync.sync() == 2
+        assert read(os.path.join(remote, 'a.txt')) == 'host'
+        assert os.path.getsize(os.path.join(host, 'big.bin')) == \
+            3 * desktop.SyncAgent.chunk
+
+        with pytest.raises(IOError):
+            peer.call('read', path='../outside')
+    finally:
+        proc.stdin.close()
+        proc.wait()
+
+
+def test_agent_path_stays_under_root(desktop):
+    assert desktop.agent_path('/r', 'a/b') == os.path.join('/r', 'a', 'b')
+    for rel in ('/etc/passwd', '../x', 'a/../../x', 'a//b', './a', ''):
+        with pytest.raises(ValueError):
+            desktop.agent_path('/r', rel)
+
+
+@pytest.fixture
+def watcher(desktop, tmp_path):
+    watcher = desktop.ChangeWatcher(str(tmp_path))
+    if watcher.fd is None:
+        pytest.skip('inotify is not available')
+    watcher.watch('')
+    yield watcher
+    if watcher.fd is not None:
+        os.close(watcher.fd)
+
+
+def test_watcher_reports_changed_paths(watcher, tmp_path):
+    assert watcher.take() == set()
+    write(str(tmp_path / 'a.txt'), 'a')
+    (tmp_path / 'sub').mkdir()
+    assert watcher.wait(1)
+    assert watcher.take() == {'a.txt', 'sub'}
+
+    watcher.watch('sub')
+    write(str(tmp_path / 'sub' / 'b.txt'), 'b')
+    os.rename(str(tmp_path / 'a.txt'), str(tmp_path / 'c.txt'))
+    assert watcher.wait(1)
+    assert watcher.take() == {'sub/b.txt', 'a.txt', 'c.txt'}
+    assert not watcher.wait(0.05)
+
+
+def test_watcher_asks_for_a_full_scan_without_inotify(watcher):
+    os.close(watcher.fd)
+    watcher.fd = None
+    assert watcher.wait(0.01)
+    assert watcher.take() is None
+
+
+def test_agent_scan_uses_watcher(desktop, tmp_path):
+    agent = desktop.SyncAgent(str(tmp_path))
+    if agent.watcher.fd is None:
+        pytest.skip('inotify is not available')
+    write(str(tmp_path / 'a.txt'), 'a')
+    assert set(agent.scan()['changes']) == {'a.txt'}
+
+    write(str(tmp_path / 'd' / 'b.txt'), 'b')
+    os.remove(str(tmp_path / 'a.txt'))
+    assert agent.wait(1)['changed']
+    assert agent.scan()['changes'] == {
+        'a.txt': None, 'd/b.txt': agent.files['d/b.txt']}
+
+
+def test_file_lock_without_waiting(desktop, tmp_path):
+    path = str(tmp_path / 'index.json.lock')
+    first, second = desktop.FileLock(path), desktop.FileLock(path)
+    assert first.acquire(blocking=False)
+    assert not second.acquire(blocking=False)
+    first.release()
+    assert second.acquire(blocking=False)
+    second.release()
+
+
+class NoDocker(object):
+    "A Docker client that a refused sync must not use"
+
+    def __getattr__(self, name):
+        raise AssertionError('Docker was used: ' + name)
+
+
+def test_one_sync_per_directory(desktop, tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    index = desktop.state_path('sync', desktop.sync_volume(str(tmp_path)) +
+                               '.json')
+    with desktop.FileLock(index + '.lock'):
+        assert desktop.start_sync(NoDocker(), 'spyder-abcdef') is None
+    assert 'Another launcher is synchronizing' in capsys.readouterr().err
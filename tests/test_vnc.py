@@ -0,0 +1,115 @@
+"""
+Tests of the VNC settings: the auto choice from the ss view of the ssh
+connection, and the RFB probe of --vnc-report against a small server on
+localhost.
+"""
+
+import argparse
+import socket
+import struct
+import threading
+
+
+SS_OUTPUT = b"""\
+State Recv-Q Send-Q Local Address:Port  Peer Address:Port Process
+ESTAB 0      0          10.0.0.5:22        10.0.0.9:40022
+\t cubic wscale:7,7 rto:204 rtt:1.5/0.5 mss:1448 send 77.2Mbps \
+delivery_rate 40Mbps app_limited
+ESTAB 0      36         10.0.0.5:22      192.0.2.7:51234
+\t cubic wscale:7,7 rto:332 rtt:120.25/3.1 mss:1448 cwnd:10 \
+send 963Kbps pacing_rate 1.9Mbps delivery_rate 4.2Mbps app_limited
+"""
+
+
+def test_link_of_the_ssh_connection(desktop, monkeypatch):
+    monkeypatch.setenv('SSH_CONNECTION', '192.0.2.7 51234 10.0.0.5 22')
+    monkeypatch.setattr(desktop.subprocess, 'check_output',
+                        lambda *args, **kwargs: SS_OUTPUT)
+    rtt, rate = desktop.measure_client_link()
+    assert abs(rtt - 0.12025) < 1e-9
+    assert rate == 4.2e6 / 8
+
+    # 525 KB/s is the third tier, and the round trip adds one more
+    assert desktop.choose_vnc_settings(rtt, rate) == \
+        {'quality': 2, 'compression': 9}
+
+
+def test_link_without_ssh(desktop, monkeypatch):
+    monkeypatch.delenv('SSH_CONNECTION', raising=False)
+    assert desktop.measure_client_link() == (0, None)
+    assert desktop.choose_vnc_settings(0, None) == \
+        {'quality': 8, 'compression': 1}
+
+
+def test_auto_is_resolved_before_the_daemon(desktop, monkeypatch):
+    monkeypatch.setattr(desktop, 'measure_client_link',
+                        lambda: (0.02, 2 << 20))
+    sent = {}
+
+    def request(daemon, method, path, body=None):
+        sent.update(body)
+        return 500, {'error': 'stop here'}
+
+    monkeypatch.setattr(desktop, 'daemon_request', request)
+    args = argparse.Namespace(size='800x600', vnc_quality='auto',
+                              vnc_compression='auto')
+    desktop.run_client({}, args, ['--vnc-quality', 'auto',
+                                  '--vnc-compression=auto', '-n'])
+    assert sent['argv'] == ['-n', '--vnc-quality', '6',
+                            '--vnc-compression', '3']
+
+
+def serve_rfb(server, updates):
+    "Answer one RFB client without a password, with Tight updates"
+
+    conn = server.accept()[0]
+
+    def read(n):
+        data = b''
+        while len(data) < n:
+            data += conn.recv(n - len(data))
+        return data
+
+    conn.sendall(b'RFB 003.008\n')
+    read(12)
+    conn.sendall(b'\x01\x01')
+    read(1)
+    conn.sendall(struct.pack('>I', 0))
+    read(1)
+    name = b'probe'
+    conn.sendall(struct.pack('>HH16xI', 64, 32, len(name)) + name)
+    read(20)
+    count = struct.unpack('>xxH', read(4))[0]
+    updates.append(struct.unpack('>%di' % count, read(4 * count)))
+
+    for _ in range(2):
+        read(10)
+        # A solid fill, then a JPEG rectangle of 200 bytes
+        conn.sendall(struct.pack('>BxH', 0, 2) +
+                     struct.pack('>HHHHi', 0, 0, 64, 16, 7) + b'\x80abc' +
+                     struct.pack('>HHHHi', 0, 16, 64, 16, 7) +
+                     b'\x90\xc8\x01' + b'j' * 200)
+    conn.close()
+
+
+def test_probe_counts_tight_updates(desktop):
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    updates = []
+    thread = threading.Thread(target=serve_rfb, args=(server, updates))
+    thread.start()
+    try:
+        probe = desktop.VNCProbe(server.getsockname()[1],
+                                 {'quality': 6, 'compression': None})
+        probe.update()
+        probe.update()
+        probe.close()
+    finally:
+        thread.join()
+        server.close()
+
+    assert (probe.width, probe.height) == (64, 32)
+    # Tight, CopyRect and Raw, and quality 6
+    assert updates == [(7, 1, 0, -26)]
+    assert probe.received == 2 * (4 + 2 * 12 + 4 + 203)